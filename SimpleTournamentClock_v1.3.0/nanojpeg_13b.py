@@ -84,6 +84,19 @@
 # (default).
 # NJ_CHROMA_FILTER=0 = Use simple pixel repetition for chroma upsampling
 # (bad quality, but faster and less code).
+# NJ_VLC_CACHE_SIZE=n = Keep up to n distinct Huffman tables between
+# decodes, so they are only built once per process (default: 16).
+# NJ_FAST_BITS=n = Decode AC symbols whose code and magnitude bits
+# together fit in n bits with a single table lookup
+# (default: 10).
+# NJ_USE_NUMPY=1 = Entropy-decode a whole scan into one coefficient array,
+# then dequantize and IDCT it with NumPy, a band of
+# blocks at a time (default, if NumPy is installed).
+# Bit-exact with the pure Python path.
+# NJ_USE_NUMPY=0 = Always decode block by block in pure Python.
+# NJ_BATCH_ROWS=n = MCU rows the NumPy path transforms and converts to RGB
+# at once, so its temporaries (int64 in the IDCT) stay
+# a few MB whatever the image size (default: 16).
 
 
 # API
@@ -128,13 +141,47 @@ __NJ_FINISHED = 6 # used internally, will never be reported
 # Parameters:
 # jpeg = The pointer to the memory dump.
 # size = The size of the JPEG file.
+# scale = 1, 2, 4 or 8: decode at 1/scale of the original size, using a
+# reduced 4x4, 2x2 or DC-only IDCT per block (optional).
+# target = (width, height): instead of a fixed scale, pick the largest
+# scale that still covers a box of that size when the image is
+# fitted into it (optional).
+# pool = A multiprocessing.Pool; if the image has restart intervals, they
+# are decoded in parallel by its workers (optional). Call
+# njShareTracker() before creating it.
 # Return value: The error code in case of failure, or NJ_OK (zero) on success.
 #nj_result_t njDecode(const void* jpeg, const int size);
 
+# njDecodeSteps: Decode a JPEG image a slice at a time.
+# Same as njDecode(), but returns a generator that decodes (and converts)
+# about rows MCU rows each time it is advanced, so that decoding can be
+# spread over the callbacks of an event loop. The result code of njDecode()
+# is the value of the StopIteration that ends it. Decoding in parallel
+# through a pool is done in a single step.
+#generator njDecodeSteps(const void* jpeg, const int size);
+
+# njProbe: Read the image information from the JPEG headers only.
+# Parses the markers up to the frame header (SOFn), without decoding any
+# image data or allocating pixel buffers. Frame types that njDecode() does
+# not support, like progressive JPEG, are still described.
+# Afterwards, njGetWidth(), njGetHeight(), njIsColor(), njIsProgressive()
+# and njGetOrientation() return the values for the image at full size.
+# Return value: The error code in case of failure, or NJ_OK (zero) on success.
+#nj_result_t njProbe(const void* jpeg, const int size);
+
+# njPickScale: Return the largest scale (1, 2, 4 or 8) for which an image of
+# the given size, decoded at 1/scale, still covers the target box when it is
+# fitted into it, so that it never has to be scaled up again.
+#int njPickScale(int width, int height, int target_width, int target_height);
+
 # njGetWidth: Return the width (in pixels) of the most recently decoded
 # image. If njDecode() failed, the result of njGetWidth() is undefined.
 #int njGetWidth(void);
 
+# njGetScale: Return the scale the most recently decoded image was decoded
+# at; njGetWidth() and njGetHeight() are already divided by it.
+#int njGetScale(void);
+
 # njGetHeight: Return the height (in pixels) of the most recently decoded
 # image. If njDecode() failed, the result of njGetHeight() is undefined.
 #int njGetHeight(void);
@@ -144,8 +191,22 @@ __NJ_FINISHED = 6 # used internally, will never be reported
 # of njGetWidth() is undefined.
 #int njIsColor(void);
 
+# njIsProgressive: Return 1 if the most recently probed image is a
+# progressive JPEG (which njDecode() cannot decode), 0 otherwise.
+#int njIsProgressive(void);
+
+# njGetOrientation: Return the EXIF orientation (1 to 8) of the most
+# recently decoded or probed image, or 1 if it has none.
+#int njGetOrientation(void);
+
+# njGetThumbnail: Return the embedded EXIF thumbnail of the most recently
+# decoded or probed image, as the bytes of a JPEG file that can be passed
+# to njDecode(), or None if it has none.
+#const void* njGetThumbnail(void);
+
 # njGetImage: Returns the decoded image data.
-# Returns a pointer to the most recently image. The memory layout it byte-
+# Returns a memoryview of the most recently image, which can be sliced
+# without copying the pixels. The memory layout it byte-
 # oriented, top-down, without any padding between lines. Pixels of color
 # images will be stored as three consecutive bytes for the red, green and
 # blue channels. This data format is thus compatible with the PGM or PPM
@@ -178,6 +239,14 @@ NJ_USE_WIN32 = 0
 
 NJ_CHROMA_FILTER = 1
 
+NJ_VLC_CACHE_SIZE = 16
+
+NJ_FAST_BITS = 10
+
+NJ_USE_NUMPY = 1
+
+NJ_BATCH_ROWS = 16
+
 
 ###############################################################################
 ## EXAMPLE PROGRAM ##
@@ -239,14 +308,39 @@ NJ_CHROMA_FILTER = 1
 
 #ifndef _NJ_INCLUDE_HEADER_ONLY
 
+from array import array
+import multiprocessing
+import os
+import re
+import struct
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    shared_memory = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # typedef struct _nj_code {
 # unsigned char bits, code;
 # } nj_vlc_code_t;
 
-class nj_vlc_code_t(object):
-    def __init__(self):
-        self.bits = 0
-        self.code = 0
+# nj_vlc_code_t is packed into an unsigned short, (bits << 8) | code, and a
+# whole table is stored as a flat array('H') of 65536 entries.  Tables are
+# only built for the table IDs a DHT segment actually defines, and identical
+# DHT tables are shared between decodes through _njVLCCache, so a worker
+# decoding a folder of images from the same camera builds them only once.
+#
+# Every table also gets a "fast AC" table, indexed by the next NJ_FAST_BITS
+# bits, for the symbols whose code and magnitude bits fit in there together.
+# An entry packs (value << 10) | (inc << 5) | bits: the sign-extended
+# coefficient, the zig-zag increment (run + 1, or 0 for EOB) and the total
+# number of bits consumed. 0 means the symbol needs the regular path.
+
+_njVLCCache = {}
 
 # typedef struct _nj_cmp {
 # int cid;
@@ -272,6 +366,7 @@ class nj_component_t(object):
         self.dctabsel = 0
         self.dcpred = 0
         self.pixels = None
+        self.coefs = None # only used by the batched (NumPy) IDCT
 
 # typedef struct _nj_ctx {
 # nj_result_t error;
@@ -292,6 +387,22 @@ class nj_component_t(object):
 # unsigned char *rgb;
 # } nj_context_t;
 
+njZZ = ( 0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5, 12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28, 35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51, 58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63 )
+
+#Zig-zag tables for reduced-size decoding: coefficients inside the top-left
+#n x n corner map to their position in an n x n block, all others to the
+#extra slot n * n, where they are decoded but never looked at.
+def njMakeZZ(n):
+    zz = []
+    for k in njZZ:
+        if ((k >> 3) < n) and ((k & 7) < n):
+            zz.append((k >> 3) * n + (k & 7))
+        else:
+            zz.append(n * n)
+    return tuple(zz)
+
+njZZScaled = { 1: njZZ, 2: njMakeZZ(4), 4: njMakeZZ(2), 8: njMakeZZ(1) }
+
 # nj_context_t now known as simply NJ
 class NJ(object):
     def init(self):
@@ -311,15 +422,29 @@ class NJ(object):
         self.qtused = 0
         self.qtavail = 0
         self.qtab = [[0] * 64, [0] * 64, [0] * 64, [0] * 64]
-        # nj_vlc_code_t vlctab[4][65536] = None
-        self.vlctab = []
-        for n in range(4):
-            self.vlctab.append([nj_vlc_code_t() for i in range(65536)])
+        # nj_vlc_code_t vlctab[4][65536]; filled in by njDecodeDHT
+        self.vlctab = [None, None, None, None]
+        self.fasttab = [None, None, None, None]
+        self.vlcspec = [None, None, None, None] # DHT definitions, for worker processes
         self.buf = 0
         self.bufbits = 0
+        self.segs = [] # unstuffed entropy-coded segments of the scan
+        self.rstmarks = [] # RST number in front of each segment (-1: none)
+        self.segidx = 0
+        self.seg = b''
+        self.segpos = 0
         self.block = [0] * 64
         self.rstinterval = 0
         self.rgb = None
+        self.progressive = 0
+        self.orientation = 1 # from the EXIF data in APP1
+        self.thumbnail = None # JPEG data of the EXIF thumbnail
+        self.scale = 1
+        self.target = None
+        self.bsize = 8 # pixels per block side at the current scale
+        self.ncoef = 64 # coefficients stored per block at the current scale
+        self.zz = njZZ # zig-zag index -> position in the stored block
+        self.batched = bool(NJ_USE_NUMPY and numpy is not None)
 
 # static nj_context_t nj;
 # nj = nj_context_t()
@@ -446,40 +571,219 @@ def njColIDCT(blk, p, sout, out, stride):
     sout[out] = njClip(((x7 - x1) >> 14) + 128)
 
 
+#Sparse variants of njRowIDCT / njColIDCT for blocks whose nonzero
+#coefficients all lie in the top left 4x4 (2x2) corner. The terms of the
+#zero inputs are left out, which gives exactly the same results. The row
+#passes return their 8 outputs instead of storing them in the block.
+#x0..x3 are the 4 (2) lowest frequencies of the row or column.
+def njRowIDCT4(x0, x1, x2, x3):
+    x0 = (x0 << 11) + 128
+    x5 = 565 * x1
+    x4 = 2841 * x1
+    x6 = 2408 * x3
+    x7 = -1609 * x3
+    x3 = 2676 * x2
+    x2 = 1108 * x2
+    x8 = x0
+    x1 = x4 + x6
+    x4 -= x6
+    x6 = x5 + x7
+    x5 -= x7
+    x7 = x8 + x3
+    x8 -= x3
+    x3 = x0 + x2
+    x0 -= x2
+    x2 = (181 * (x4 + x5) + 128) >> 8
+    x4 = (181 * (x4 - x5) + 128) >> 8
+    return ((x7 + x1) >> 8, (x3 + x2) >> 8, (x0 + x4) >> 8, (x8 + x6) >> 8,
+            (x8 - x6) >> 8, (x0 - x4) >> 8, (x3 - x2) >> 8, (x7 - x1) >> 8)
+
+def njRowIDCT2(x0, x1):
+    x0 = (x0 << 11) + 128
+    x5 = 565 * x1
+    x1 = 2841 * x1
+    x2 = (181 * (x1 + x5) + 128) >> 8
+    x4 = (181 * (x1 - x5) + 128) >> 8
+    return ((x0 + x1) >> 8, (x0 + x2) >> 8, (x0 + x4) >> 8, (x0 + x5) >> 8,
+            (x0 - x5) >> 8, (x0 - x4) >> 8, (x0 - x2) >> 8, (x0 - x1) >> 8)
+
+def njColIDCT4(x0, x1, x2, x3, sout, out, stride):
+    x0 = (x0 << 8) + 8192
+    x5 = (565 * x1 + 4) >> 3
+    x4 = (2841 * x1 + 4) >> 3
+    x6 = (2408 * x3 + 4) >> 3
+    x7 = (4 - 1609 * x3) >> 3
+    x3 = (2676 * x2 + 4) >> 3
+    x2 = (1108 * x2 + 4) >> 3
+    x8 = x0
+    x1 = x4 + x6
+    x4 -= x6
+    x6 = x5 + x7
+    x5 -= x7
+    x7 = x8 + x3
+    x8 -= x3
+    x3 = x0 + x2
+    x0 -= x2
+    x2 = (181 * (x4 + x5) + 128) >> 8
+    x4 = (181 * (x4 - x5) + 128) >> 8
+    for x in ((x7 + x1), (x3 + x2), (x0 + x4), (x8 + x6),
+              (x8 - x6), (x0 - x4), (x3 - x2), (x7 - x1)):
+        x = (x >> 14) + 128
+        sout[out] = 0 if x < 0 else (0xFF if x > 0xFF else x)
+        out += stride
+
+def njColIDCT2(x0, x1, sout, out, stride):
+    x0 = (x0 << 8) + 8192
+    x5 = (565 * x1 + 4) >> 3
+    x1 = (2841 * x1 + 4) >> 3
+    x2 = (181 * (x1 + x5) + 128) >> 8
+    x4 = (181 * (x1 - x5) + 128) >> 8
+    for x in ((x0 + x1), (x0 + x2), (x0 + x4), (x0 + x5),
+              (x0 - x5), (x0 - x4), (x0 - x2), (x0 - x1)):
+        x = (x >> 14) + 128
+        sout[out] = 0 if x < 0 else (0xFF if x > 0xFF else x)
+        out += stride
+
+#block with a single color, for DC-only blocks
+def njFillBlock(sout, out, stride, n, x):
+    row = bytes((x,)) * n
+    for y in range(n):
+        sout[out:out + n] = row
+        out += stride
+
+njZeros = [0] * 64
+
+
+#Reduced IDCTs for decoding at 1/2 and 1/4 size. They transform the lowest
+#4 (2) frequencies of each row/column into 4 (2) samples, i.e.
+#f(n) = 1/2 * sum(C(u) * F(u) * cos((2n + 1) * u * pi / (2 * N))), with the
+#cosines as 13-bit fixed point numbers. The row pass keeps 2 extra bits of
+#precision (shift = 12), the column pass removes them again (shift = 16).
+#They work on ints as well as on NumPy arrays, so both decoding paths
+#produce the same bytes.
+def njIDCT4(x0, x1, x2, x3, shift):
+    r = 1 << (shift - 1)
+    e0 = 5793 * (x0 + x2) + r
+    e1 = 5793 * (x0 - x2) + r
+    o0 = 7568 * x1 + 3135 * x3
+    o1 = 3135 * x1 - 7568 * x3
+    return ((e0 + o0) >> shift, (e1 + o1) >> shift, (e1 - o1) >> shift, (e0 - o0) >> shift)
+
+def njIDCT2(x0, x1, shift):
+    r = 1 << (shift - 1)
+    return ((5793 * (x0 + x1) + r) >> shift, (5793 * (x0 - x1) + r) >> shift)
+
+#blk holds a 4x4 (2x2, 1x1) block of dequantized coefficients
+def njIDCT4x4(blk, sout, out, stride):
+    def njClip(x):
+        if x < 0: return 0
+        if x > 0xFF: return 0xFF
+        return x
+    r0 = njIDCT4(blk[0], blk[1], blk[2], blk[3], 12)
+    r1 = njIDCT4(blk[4], blk[5], blk[6], blk[7], 12)
+    r2 = njIDCT4(blk[8], blk[9], blk[10], blk[11], 12)
+    r3 = njIDCT4(blk[12], blk[13], blk[14], blk[15], 12)
+    for x in range(4):
+        y0, y1, y2, y3 = njIDCT4(r0[x], r1[x], r2[x], r3[x], 16)
+        sout[out + x] = njClip(y0 + 128)
+        sout[out + stride + x] = njClip(y1 + 128)
+        sout[out + 2 * stride + x] = njClip(y2 + 128)
+        sout[out + 3 * stride + x] = njClip(y3 + 128)
+
+def njIDCT2x2(blk, sout, out, stride):
+    def njClip(x):
+        if x < 0: return 0
+        if x > 0xFF: return 0xFF
+        return x
+    r0 = njIDCT2(blk[0], blk[1], 12)
+    r1 = njIDCT2(blk[2], blk[3], 12)
+    for x in range(2):
+        y0, y1 = njIDCT2(r0[x], r1[x], 16)
+        sout[out + x] = njClip(y0 + 128)
+        sout[out + stride + x] = njClip(y1 + 128)
+
+def njIDCT1x1(blk, sout, out, stride):
+    # same as the DC-only case of njRowIDCT + njColIDCT
+    x = ((blk[0] + 4) >> 3) + 128
+    if x < 0: x = 0
+    if x > 0xFF: x = 0xFF
+    sout[out] = x
+
+
+#The entropy-coded data of a scan is read in one pass up front: it is split
+#at the RST markers and the 0xFF 0x00 byte stuffing is removed from every
+#segment. Bits are then served from nj.buf, a window of up to 64 bits that
+#is refilled 48 bits at a time, so a refill is only needed every few symbols.
+#Past the end of a segment, the window is padded with 1 bits.
+
+_njMarker = re.compile(b'\xff[^\x00]')
+
+def njSplitScan(nj):
+    data = bytes(nj.spos[nj.pos:nj.pos + nj.size])
+    nj.segs = []
+    nj.rstmarks = []
+    mark = -1
+    pieces = []
+    start = 0
+    pos = 0
+    while True:
+        m = _njMarker.search(data, pos)
+        if m is None:
+            pos = len(data)
+            break
+        pos = m.start()
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # fill byte in front of a marker
+            pieces.append(data[start:pos])
+            start = pos = pos + 1
+            continue
+        if (marker & 0xF8) != 0xD0:
+            break # end of the entropy-coded data (EOI or another marker)
+        pieces.append(data[start:pos])
+        nj.segs.append(b''.join(pieces).replace(b'\xff\x00', b'\xff'))
+        nj.rstmarks.append(mark)
+        mark = marker & 7
+        pieces = []
+        start = pos = pos + 2
+    pieces.append(data[start:pos])
+    nj.segs.append(b''.join(pieces).replace(b'\xff\x00', b'\xff'))
+    nj.rstmarks.append(mark)
+    njSkip(nj, pos)
+    nj.segidx = 0
+    nj.seg = nj.segs[0]
+    nj.segpos = 0
+    nj.buf = 0
+    nj.bufbits = 0
+
+#returns the refilled (buf, bufbits)
+def njRefill(nj, buf, bufbits):
+    p = nj.segpos
+    nj.segpos = p + 6
+    chunk = nj.seg[p:p + 6]
+    if len(chunk) < 6:
+        chunk += b'\xff\xff\xff\xff\xff\xff'[len(chunk):]
+    return ((buf & ((1 << bufbits) - 1)) << 48) | int.from_bytes(chunk, 'big'), bufbits + 48
+
+#moves on to the next segment, which has to start with RST marker nextrst
+def njRestart(nj, nextrst):
+    nj.segidx += 1
+    if (nj.segidx >= len(nj.segs)) or (nj.rstmarks[nj.segidx] != nextrst):
+        raise Exception(NJ_SYNTAX_ERROR)
+    nj.seg = nj.segs[nj.segidx]
+    nj.segpos = 0
+    nj.buf = 0
+    nj.bufbits = 0
+
 def njShowBits(nj, bits):
     if (not bits): return 0
-    while (nj.bufbits < bits):
-        if (nj.size <= 0):
-            nj.buf = (nj.buf << 8) | 0xFF
-            nj.bufbits += 8
-            continue
-        
-        newbyte = nj.spos[nj.pos]
-        nj.pos += 1
-        nj.size -= 1
-        nj.bufbits += 8
-        nj.buf = (nj.buf << 8) | newbyte
-        if (newbyte == 0xFF):
-            if (nj.size):
-                marker = nj.spos[nj.pos]
-                nj.pos += 1
-                nj.size -= 1
-                if marker == 0xD9:
-                    nj.size = 0
-                elif marker != 0 and marker != 0xFF:
-                    if ((marker & 0xF8) != 0xD0):
-                        raise Exception(NJ_SYNTAX_ERROR)
-                    else:
-                        nj.buf = (nj.buf << 8) | marker
-                        nj.bufbits += 8
-            else:
-                raise Exception(NJ_SYNTAX_ERROR)
-    nj.buf = nj.buf & ((1 << nj.bufbits) - 1)
+    if (nj.bufbits < bits):
+        nj.buf, nj.bufbits = njRefill(nj, nj.buf, nj.bufbits)
     return (nj.buf >> (nj.bufbits - bits)) & ((1 << bits) - 1)
 
 def njSkipBits(nj, bits):
     if (nj.bufbits < bits):
-        njShowBits(bits)
+        njShowBits(nj, bits)
     nj.bufbits -= bits
 
 def njGetBits(nj, bits):
@@ -487,9 +791,6 @@ def njGetBits(nj, bits):
     njSkipBits(nj, bits)
     return res
 
-def njByteAlign(nj):
-    nj.bufbits &= 0xF8
-
 def njSkip(nj, count):
     nj.pos += count
     nj.size -= count
@@ -511,6 +812,54 @@ def njSkipMarker(nj):
     njDecodeLength(nj)
     njSkip(nj, nj.length)
 
+#only the orientation and the thumbnail are taken from the EXIF data
+def njDecodeAPP1(nj):
+    njDecodeLength(nj)
+    njDecodeExif(nj, bytes(nj.spos[nj.pos:nj.pos + nj.length]))
+    njSkip(nj, nj.length)
+
+def njDecodeExif(nj, data):
+    if data[:6] != b'Exif\0\0':
+        return
+    tiff = data[6:]
+    if tiff[:4] == b'II*\0':
+        order = '<'
+    elif tiff[:4] == b'MM\0*':
+        order = '>'
+    else:
+        return
+    try:
+        ifd = struct.unpack_from(order + 'I', tiff, 4)[0]
+        count = struct.unpack_from(order + 'H', tiff, ifd)[0]
+        for i in range(count):
+            tag, type, n, value = struct.unpack_from(order + 'HHI4s', tiff, ifd + 2 + 12 * i)
+            if tag == 0x0112 and type == 3: # orientation, SHORT
+                orientation = struct.unpack_from(order + 'H', value)[0]
+                if 1 <= orientation <= 8:
+                    nj.orientation = orientation
+        # IFD1 describes the thumbnail
+        ifd = struct.unpack_from(order + 'I', tiff, ifd + 2 + 12 * count)[0]
+        if not ifd:
+            return
+        count = struct.unpack_from(order + 'H', tiff, ifd)[0]
+        offset = 0
+        length = 0
+        for i in range(count):
+            tag, type, n, value = struct.unpack_from(order + 'HHI4s', tiff, ifd + 2 + 12 * i)
+            if type == 3:
+                value = struct.unpack_from(order + 'H', value)[0]
+            elif type == 4:
+                value = struct.unpack_from(order + 'I', value)[0]
+            else:
+                continue
+            if tag == 0x0201: offset = value # JPEGInterchangeFormat
+            elif tag == 0x0202: length = value # JPEGInterchangeFormatLength
+        thumbnail = tiff[offset:offset + length]
+        if offset and (len(thumbnail) == length) and (thumbnail[:2] == b'\xff\xd8'):
+            nj.thumbnail = thumbnail
+    except struct.error:
+        pass # truncated EXIF data, keep what was found
+
 def njDecodeSOF(nj):
     ssxmax = 0
     ssymax = 0
@@ -558,6 +907,24 @@ def njDecodeSOF(nj):
     nj.mbsizey = ssymax << 3
     nj.mbwidth = (nj.width + nj.mbsizex - 1) // nj.mbsizex
     nj.mbheight = (nj.height + nj.mbsizey - 1) // nj.mbsizey
+    if nj.target:
+        nj.scale = njPickScale(nj.width, nj.height, nj.target[0], nj.target[1])
+    # the chroma upsampler needs at least 3 samples, so tiny images fall
+    # back to a smaller scale
+    while nj.scale > 1:
+        for i in range(nj.ncomp):
+            c = nj.comp[i]
+            w = ((nj.width * c.ssx + ssxmax - 1) // ssxmax + nj.scale - 1) // nj.scale
+            h = ((nj.height * c.ssy + ssymax - 1) // ssymax + nj.scale - 1) // nj.scale
+            if (((w < 3) and (c.ssx != ssxmax)) or ((h < 3) and (c.ssy != ssymax))):
+                break
+        else:
+            break
+        nj.scale >>= 1
+    nj.bsize = 8 // nj.scale
+    nj.ncoef = 64 if nj.scale == 1 else nj.bsize * nj.bsize + 1
+    nj.zz = njZZScaled[nj.scale]
+    nj.block = [0] * nj.ncoef
     i = 0
     while i < nj.ncomp:
         c = nj.comp[i]
@@ -567,14 +934,69 @@ def njDecodeSOF(nj):
         c.stride = nj.mbwidth * nj.mbsizex * c.ssx // ssxmax
         if (((c.width < 3) and (c.ssx != ssxmax)) or ((c.height < 3) and (c.ssy != ssymax))):
                 raise Exception(NJ_UNSUPPORTED)
-        c.pixels = [0] * (c.stride * (nj.mbheight * nj.mbsizey * c.ssy // ssymax))
+        c.width = (c.width + nj.scale - 1) // nj.scale
+        c.height = (c.height + nj.scale - 1) // nj.scale
+        c.stride //= nj.scale
+        nblocks = (nj.mbwidth * c.ssx) * (nj.mbheight * c.ssy)
+        if nj.batched:
+            c.coefs = array('i', [0]) * (nblocks * nj.ncoef)
+        else:
+            c.pixels = bytearray(nblocks * nj.bsize * nj.bsize)
         i += 1
+    nj.width = (nj.width + nj.scale - 1) // nj.scale
+    nj.height = (nj.height + nj.scale - 1) // nj.scale
     if (nj.ncomp == 3):
-        nj.rgb = [0] * (nj.width * nj.height * nj.ncomp)
+        nj.rgb = bytearray(nj.width * nj.height * nj.ncomp)
     njSkip(nj, nj.length)
 
+#spec is the DHT table definition: 16 code counts followed by the symbols
+def njBuildVLC(spec):
+    vlctab = array('H', [0]) * 65536
+    vlc = 0
+    pos = 16
+    spread = 65536
+    for codelen in range(1, 17): # 1 to 16
+        spread >>= 1
+        for ii in range(spec[codelen - 1]):
+            vlctab[vlc:vlc + spread] = array('H', [(codelen << 8) | spec[pos]]) * spread
+            vlc += spread
+            pos += 1
+    # the remaining entries are left at bits = 0 (invalid code)
+    return vlctab
+
+#builds the fast AC table (see above) for the given VLC table
+def njBuildFast(vlctab):
+    fast = array('i', [0]) * (1 << NJ_FAST_BITS)
+    for i in range(1 << NJ_FAST_BITS):
+        code = vlctab[i << (16 - NJ_FAST_BITS)]
+        bits = code >> 8
+        code &= 0xFF
+        size = code & 15
+        if (not bits) or (bits + size > NJ_FAST_BITS):
+            continue
+        if code and (not size) and (code != 0xF0):
+            continue # invalid, leave the error to the regular path
+        value = 0
+        if size:
+            value = (i >> (NJ_FAST_BITS - bits - size)) & ((1 << size) - 1)
+            if (value < (1 << (size - 1))):
+                value += ((-1) << size) + 1
+        inc = ((code >> 4) + 1) if code else 0
+        fast[i] = (value << 10) | (inc << 5) | (bits + size)
+    return fast
+
+#returns the (VLC, fast AC) tables for a DHT table definition
+def njGetVLCTables(spec):
+    tabs = _njVLCCache.get(spec)
+    if tabs is None:
+        vlctab = njBuildVLC(spec)
+        tabs = (vlctab, njBuildFast(vlctab))
+        if len(_njVLCCache) >= NJ_VLC_CACHE_SIZE:
+            del _njVLCCache[next(iter(_njVLCCache))]
+        _njVLCCache[spec] = tabs
+    return tabs
+
 def njDecodeDHT(nj):
-    counts = [0] * 16
     njDecodeLength(nj)
     while (nj.length >= 17):
         i = nj.spos[nj.pos]
@@ -583,34 +1005,21 @@ def njDecodeDHT(nj):
         if (i & 0x02):
             raise Exception(NJ_UNSUPPORTED)
         i = (i | (i >> 3)) & 3 # combined DC/AC + tableid value
-        for codelen in range(1, 17): # 1 to 16
-            counts[codelen - 1] = nj.spos[nj.pos + codelen]
+        start = nj.pos + 1
         njSkip(nj,17)
-        vlc = 0
         remain = 65536
-        spread = 65536
         for codelen in range(1, 17): # 1 to 16
-            spread >>= 1
-            currcnt = counts[codelen - 1]
+            currcnt = nj.spos[start + codelen - 1]
             if not currcnt: continue
             if (nj.length < currcnt):
                 raise Exception(NJ_SYNTAX_ERROR)
             remain -= currcnt << (16 - codelen)
             if (remain < 0):
                 raise Exception(NJ_SYNTAX_ERROR)
-            for ii in range(currcnt):
-                code = nj.spos[nj.pos + ii]
-                j = spread
-                while j:
-                    nj.vlctab[i][vlc].bits = codelen
-                    nj.vlctab[i][vlc].code = code
-                    vlc += 1
-                    j -= 1
             njSkip(nj, currcnt)
-        while remain:
-            remain -= 1
-            nj.vlctab[i][vlc].bits = 0
-            vlc += 1
+        spec = bytes(nj.spos[start:nj.pos])
+        nj.vlcspec[i] = spec
+        nj.vlctab[i], nj.fasttab[i] = njGetVLCTables(spec)
     if (nj.length):
         raise Exception(NJ_SYNTAX_ERROR)
 
@@ -636,52 +1045,260 @@ def njDecodeDRI(nj):
 
 #code is an array with one element, since we need to return the code to the caller
 def njGetVLC(nj, vlc, code):
-    value = njShowBits(nj, 16)
-    bits = vlc[value].bits
+    # a Huffman code plus its magnitude bits never exceed 32 bits
+    if nj.bufbits < 32:
+        nj.buf, nj.bufbits = njRefill(nj, nj.buf, nj.bufbits)
+    value = vlc[(nj.buf >> (nj.bufbits - 16)) & 0xFFFF]
+    bits = value >> 8
     if not bits:
         raise Exception(NJ_SYNTAX_ERROR)
-    njSkipBits(nj, bits)
-    value = vlc[value].code
+    nj.bufbits -= bits
+    value &= 0xFF
     if code: code[0] = value
     bits = value & 15
     if not bits: return 0
-    value = njGetBits(nj, bits)
+    nj.bufbits -= bits
+    value = (nj.buf >> nj.bufbits) & ((1 << bits) - 1)
     if (value < (1 << (bits - 1))):
         value += ((-1) << bits) + 1
     return value
 
-#sout is a new parameter, because we need to modify the passed in array, so
-#out is now just the index in out
-def njDecodeBlock(nj, c, sout, out):
-    njZZ = ( 0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5, 12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28, 35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51, 58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63 )
+#quantization table used when the coefficients are dequantized later on
+njUnitQT = (1,) * 64
+
+#entropy-decodes one block into blk[p:p+nj.ncoef] (natural order, cut down
+#to nj.bsize x nj.bsize), multiplying each coefficient with the (zig-zag
+#ordered) quantization table qt. Returns the highest zig-zag index written.
+def njDecodeCoefs(nj, c, blk, p, qt):
+    zz = nj.zz
     code = [0]
     value = 0
     coef = 0
-    nj.block = [0 for i in nj.block]
-    # @@ for i in range(len(nj.block)):
-    # @@    nj.block[i] = 0
     c.dcpred += njGetVLC(nj,nj.vlctab[c.dctabsel], None)
-    nj.block[0] = c.dcpred * nj.qtab[c.qtsel][0]
+    blk[p] = c.dcpred * qt[0]
+    vlc = nj.vlctab[c.actabsel]
+    fast = nj.fasttab[c.actabsel]
+    fastshift = NJ_FAST_BITS
+    fastmask = (1 << NJ_FAST_BITS) - 1
+    # the bit window is kept in locals while the fast path is used
+    buf = nj.buf
+    bufbits = nj.bufbits
     while True: # do {
-        value = njGetVLC(nj,nj.vlctab[c.actabsel], code);
-        if not code[0]: break # EOB
-        if (not (code[0] & 0x0F) and (code[0] != 0xF0)):
-            raise Exception(NJ_SYNTAX_ERROR)
-        coef += (code[0] >> 4) + 1
-        if coef > 63:
-            raise Exception(NJ_SYNTAX_ERROR)
-        nj.block[njZZ[coef]] = value * nj.qtab[c.qtsel][coef]
+        if bufbits < 32:
+            buf, bufbits = njRefill(nj, buf, bufbits)
+        e = fast[(buf >> (bufbits - fastshift)) & fastmask]
+        if e:
+            bufbits -= e & 31
+            if not (e & 0x3E0): break # EOB
+            coef += (e >> 5) & 31
+            if coef > 63:
+                raise Exception(NJ_SYNTAX_ERROR)
+            blk[p + zz[coef]] = (e >> 10) * qt[coef]
+        else:
+            nj.buf = buf
+            nj.bufbits = bufbits
+            value = njGetVLC(nj, vlc, code)
+            buf = nj.buf
+            bufbits = nj.bufbits
+            if not code[0]: break # EOB
+            if (not (code[0] & 0x0F) and (code[0] != 0xF0)):
+                raise Exception(NJ_SYNTAX_ERROR)
+            coef += (code[0] >> 4) + 1
+            if coef > 63:
+                raise Exception(NJ_SYNTAX_ERROR)
+            blk[p + zz[coef]] = value * qt[coef]
         # } while (coef < 63);
         if coef >= 63: break
+    nj.buf = buf
+    nj.bufbits = bufbits
+    return coef
+
+#sout is a new parameter, because we need to modify the passed in array, so
+#out is now just the index in out
+#nj.block is all zeros between calls; only the entries that were written
+#are cleared again afterwards.
+def njDecodeBlock(nj, c, sout, out):
+    blk = nj.block
+    last = njDecodeCoefs(nj, c, blk, 0, nj.qtab[c.qtsel])
+    stride = c.stride
+    if nj.scale == 8:
+        njIDCT1x1(blk, sout, out, stride)
+        blk[0] = 0
+        return
+    if nj.scale != 1:
+        if not last:
+            x = njIDCT2(njIDCT2(blk[0], 0, 12)[0], 0, 16)[0] + 128
+            njFillBlock(sout, out, stride, nj.bsize, 0 if x < 0 else (0xFF if x > 0xFF else x))
+            blk[0] = 0
+            return
+        if nj.scale == 2:
+            njIDCT4x4(blk, sout, out, stride)
+        else:
+            njIDCT2x2(blk, sout, out, stride)
+        blk[:] = njZeros[:nj.ncoef]
+        return
+    if not last:
+        x = ((blk[0] + 4) >> 3) + 128
+        njFillBlock(sout, out, stride, 8, 0 if x < 0 else (0xFF if x > 0xFF else x))
+        blk[0] = 0
+        return
+    if last <= 2: # only blk[0], blk[1] and blk[8] can be nonzero
+        r0 = njRowIDCT2(blk[0], blk[1])
+        r1 = (blk[8] << 3,) * 8
+        for coef in range(8):
+            njColIDCT2(r0[coef], r1[coef], sout, out + coef, stride)
+        blk[0] = blk[1] = blk[8] = 0
+        return
+    if last <= 9: # only the top left 4x4 coefficients can be nonzero
+        r0 = njRowIDCT4(blk[0], blk[1], blk[2], blk[3])
+        r1 = njRowIDCT4(blk[8], blk[9], blk[10], blk[11])
+        r2 = njRowIDCT4(blk[16], blk[17], blk[18], blk[19])
+        r3 = njRowIDCT4(blk[24], blk[25], blk[26], blk[27])
+        for coef in range(8):
+            njColIDCT4(r0[coef], r1[coef], r2[coef], r3[coef], sout, out + coef, stride)
+        blk[0:28] = njZeros[0:28]
+        return
     coef = 0
     while coef < 64:
-        njRowIDCT(nj.block, coef)
+        njRowIDCT(blk, coef)
         coef += 8
     for coef in range(8):
-        njColIDCT(nj.block, coef, sout, out + coef, c.stride)
+        njColIDCT(blk, coef, sout, out + coef, stride)
+    blk[:] = njZeros
+
+#Batched counterpart of njRowIDCT: b has the block rows along its last axis.
+def njRowIDCTBatch(b):
+    x0 = (b[..., 0] << 11) + 128
+    x1 = b[..., 4] << 11
+    x2 = b[..., 6]
+    x3 = b[..., 2]
+    x4 = b[..., 1]
+    x5 = b[..., 7]
+    x6 = b[..., 5]
+    x7 = b[..., 3]
+    # no all-AC-zero shortcut needed, the general case yields the same result
+    x8 = 565 * (x4 + x5)
+    x4 = x8 + (2841 - 565) * x4
+    x5 = x8 - (2841 + 565) * x5
+    x8 = 2408 * (x6 + x7)
+    x6 = x8 - (2408 - 1609) * x6
+    x7 = x8 - (2408 + 1609) * x7
+    x8 = x0 + x1
+    x0 = x0 - x1
+    x1 = 1108 * (x3 + x2)
+    x2 = x1 - (2676 + 1108) * x2
+    x3 = x1 + (2676 - 1108) * x3
+    x1 = x4 + x6
+    x4 = x4 - x6
+    x6 = x5 + x7
+    x5 = x5 - x7
+    x7 = x8 + x3
+    x8 = x8 - x3
+    x3 = x0 + x2
+    x0 = x0 - x2
+    x2 = (181 * (x4 + x5) + 128) >> 8
+    x4 = (181 * (x4 - x5) + 128) >> 8
+    return numpy.stack(((x7 + x1) >> 8, (x3 + x2) >> 8, (x0 + x4) >> 8, (x8 + x6) >> 8,
+                        (x8 - x6) >> 8, (x0 - x4) >> 8, (x3 - x2) >> 8, (x7 - x1) >> 8), axis=-1)
+
+#Batched counterpart of njColIDCT: b has the block columns along its
+#second-to-last axis. Returns the clipped samples.
+def njColIDCTBatch(b):
+    x0 = (b[..., 0, :] << 8) + 8192
+    x1 = b[..., 4, :] << 8
+    x2 = b[..., 6, :]
+    x3 = b[..., 2, :]
+    x4 = b[..., 1, :]
+    x5 = b[..., 7, :]
+    x6 = b[..., 5, :]
+    x7 = b[..., 3, :]
+    x8 = 565 * (x4 + x5) + 4
+    x4 = (x8 + (2841 - 565) * x4) >> 3
+    x5 = (x8 - (2841 + 565) * x5) >> 3
+    x8 = 2408 * (x6 + x7) + 4
+    x6 = (x8 - (2408 - 1609) * x6) >> 3
+    x7 = (x8 - (2408 + 1609) * x7) >> 3
+    x8 = x0 + x1
+    x0 = x0 - x1
+    x1 = 1108 * (x3 + x2) + 4
+    x2 = (x1 - (2676 + 1108) * x2) >> 3
+    x3 = (x1 + (2676 - 1108) * x3) >> 3
+    x1 = x4 + x6
+    x4 = x4 - x6
+    x6 = x5 + x7
+    x5 = x5 - x7
+    x7 = x8 + x3
+    x8 = x8 - x3
+    x3 = x0 + x2
+    x0 = x0 - x2
+    x2 = (181 * (x4 + x5) + 128) >> 8
+    x4 = (181 * (x4 - x5) + 128) >> 8
+    out = numpy.stack(((x7 + x1) >> 14, (x3 + x2) >> 14, (x0 + x4) >> 14, (x8 + x6) >> 14,
+                       (x8 - x6) >> 14, (x0 - x4) >> 14, (x3 - x2) >> 14, (x7 - x1) >> 14), axis=-2)
+    return numpy.clip(out + 128, 0, 0xFF)
+
+#dequantizes and transforms the coefficients of c.coefs NJ_BATCH_ROWS MCU
+#rows at a time, and stores the result in c.pixels
+def njIDCTBatch(nj, c):
+    n = nj.bsize
+    nbx = c.stride // n
+    nby = len(c.coefs) // (nbx * nj.ncoef)
+    qt = [0] * nj.ncoef
+    for i in range(64):
+        qt[nj.zz[i]] = nj.qtab[c.qtsel][i]
+    qt = numpy.array(qt[:n * n], dtype=numpy.int64)
+    coefs = numpy.frombuffer(c.coefs, dtype=numpy.int32).reshape(nby, nbx, nj.ncoef)
+    pixels = bytearray(nby * n * c.stride)
+    plane = numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(nby, n, nbx, n)
+    band = NJ_BATCH_ROWS * c.ssy
+    for by in range(0, nby, band):
+        # int64, since the intermediate values overflow 32 bits for large coefficients
+        blk = (coefs[by:by + band, :, :n * n].astype(numpy.int64) * qt).reshape(-1, nbx, n, n)
+        if n == 8:
+            out = njColIDCTBatch(njRowIDCTBatch(blk))
+        elif n == 4:
+            rows = numpy.stack(njIDCT4(blk[..., 0], blk[..., 1], blk[..., 2], blk[..., 3], 12), axis=-1)
+            out = numpy.stack(njIDCT4(rows[..., 0, :], rows[..., 1, :], rows[..., 2, :], rows[..., 3, :], 16), axis=-2)
+            out = numpy.clip(out + 128, 0, 0xFF)
+        elif n == 2:
+            rows = numpy.stack(njIDCT2(blk[..., 0], blk[..., 1], 12), axis=-1)
+            out = numpy.stack(njIDCT2(rows[..., 0, :], rows[..., 1, :], 16), axis=-2)
+            out = numpy.clip(out + 128, 0, 0xFF)
+        else:
+            out = numpy.clip(((blk + 4) >> 3) + 128, 0, 0xFF)
+        plane[by:by + band] = out.transpose(0, 2, 1, 3)
+    del coefs, plane
+    c.pixels = pixels
+    c.coefs = None
+
+#decodes count MCUs, starting with MCU number first, from the current
+#position in the bitstream
+def njDecodeInterval(nj, first, count):
+    mbx = first % nj.mbwidth
+    mby = first // nj.mbwidth
+    while count:
+        i = 0
+        while (i < nj.ncomp):
+            c = nj.comp[i]
+            sby = 0
+            while sby < c.ssy:
+                sbx = 0
+                while sbx < c.ssx:
+                    if nj.batched:
+                        njDecodeCoefs(nj, c, c.coefs, ((mby * c.ssy + sby) * (c.stride // nj.bsize) + mbx * c.ssx + sbx) * nj.ncoef, njUnitQT)
+                    else:
+                        njDecodeBlock(nj, c, c.pixels, ((mby * c.ssy + sby) * c.stride + mbx * c.ssx + sbx) * nj.bsize)
+                    sbx += 1
+                sby += 1
+            i += 1
+        mbx += 1
+        if mbx >= nj.mbwidth:
+            mbx = 0
+            mby += 1
+        count -= 1
 
-def njDecodeScan(nj):
-    rstcount = nj.rstinterval
+#generator: yields after every rows MCU rows
+def njDecodeScan(nj, pool=None, rows=None):
     nextrst = 0
     # nj_component_t* c;
     njDecodeLength(nj)
@@ -699,45 +1316,145 @@ def njDecodeScan(nj):
             raise Exception(NJ_SYNTAX_ERROR)
         c.dctabsel = nj.spos[nj.pos + 1] >> 4
         c.actabsel = (nj.spos[nj.pos + 1] & 1) | 2
+        if (nj.vlctab[c.dctabsel] is None) or (nj.vlctab[c.actabsel] is None):
+            raise Exception(NJ_SYNTAX_ERROR)
         njSkip(nj,2)
         i += 1
     if (nj.spos[nj.pos] or (nj.spos[nj.pos + 1] != 63) or nj.spos[nj.pos + 2]):
         raise Exception(NJ_UNSUPPORTED)
     njSkip(nj,nj.length)
-    mbx = 0
-    mby = 0
-    while True:
-        i = 0
-        while (i < nj.ncomp):
+    njSplitScan(nj)
+    mcus = nj.mbwidth * nj.mbheight
+    interval = nj.rstinterval or mcus
+    if (pool is not None) and (shared_memory is not None) and (nj.rstinterval) and (len(nj.segs) > 1):
+        njDecodeParallel(nj, pool)
+    else:
+        step = rows * nj.mbwidth if rows else mcus
+        budget = step
+        first = 0
+        while first < mcus:
+            if first and not (first % interval):
+                njRestart(nj, nextrst)
+                nextrst = (nextrst + 1) & 7
+                for i in range(3):
+                    nj.comp[i].dcpred = 0
+            count = min(interval - first % interval, mcus - first, budget)
+            njDecodeInterval(nj, first, count)
+            first += count
+            budget -= count
+            if not budget:
+                yield
+                budget = step
+    if nj.batched:
+        for i in range(nj.ncomp):
+            njIDCTBatch(nj, nj.comp[i])
+    nj.error = __NJ_FINISHED
+
+#Restart intervals are independent of each other (the DC predictors are
+#reset at every RST marker), so with a process pool they are decoded in
+#parallel: njDecodeParallel hands contiguous runs of intervals to the
+#workers, which write pixels (or coefficients, if batched) straight into
+#shared memory holding the component planes.
+def njDecodeParallel(nj, pool):
+    mcus = nj.mbwidth * nj.mbheight
+    intervals = []
+    first = 0
+    while first < mcus:
+        k = len(intervals)
+        if (k >= len(nj.segs)) or (k and (nj.rstmarks[k] != ((k - 1) & 7))):
+            raise Exception(NJ_SYNTAX_ERROR)
+        count = min(nj.rstinterval, mcus - first)
+        intervals.append((first, count, nj.segs[k]))
+        first += count
+    state = (nj.mbwidth, nj.scale, nj.batched, nj.qtab, nj.vlcspec,
+             [(c.ssx, c.ssy, c.stride, c.qtsel, c.dctabsel, c.actabsel) for c in nj.comp[:nj.ncomp]])
+    shms = []
+    try:
+        for i in range(nj.ncomp):
             c = nj.comp[i]
-            sby = 0
-            while sby < c.ssy:
-                sbx = 0
-                while sbx < c.ssx:
-                    njDecodeBlock(nj, c, c.pixels, ((mby * c.ssy + sby) * c.stride + mbx * c.ssx + sbx) << 3)
-                    if nj.error:
-                        return
-                    sbx += 1
-                sby += 1
-            i += 1
-        mbx += 1
-        if mbx >= nj.mbwidth:
-            mbx = 0
-            mby += 1
-            if mby >= nj.mbheight: break
-        rstcount -= 1
-        if (nj.rstinterval and not rstcount):
-            njByteAlign(nj)
-            i = njGetBits(nj, 16)
-            if (((i & 0xFFF8) != 0xFFD0) or ((i & 7) != nextrst)):
-                raise Exception(NJ_SYNTAX_ERROR)
-            nextrst = (nextrst + 1) & 7
-            rstcount = nj.rstinterval
-            for i in range(3):
+            if nj.batched:
+                shms.append(shared_memory.SharedMemory(create=True, size=len(c.coefs) * c.coefs.itemsize))
+            else:
+                shms.append(shared_memory.SharedMemory(create=True, size=len(c.pixels)))
+        names = [shm.name for shm in shms]
+        ntasks = min(len(intervals), 4 * multiprocessing.cpu_count())
+        tasks = [(state, names, intervals[k * len(intervals) // ntasks:(k + 1) * len(intervals) // ntasks])
+                 for k in range(ntasks)]
+        pool.map(njDecodeIntervals, tasks)
+        for i in range(nj.ncomp):
+            c = nj.comp[i]
+            if nj.batched:
+                c.coefs = array('i')
+                c.coefs.frombytes(shms[i].buf)
+            else:
+                c.pixels = bytearray(shms[i].buf)
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+#starts the shared memory resource tracker, before a pool is created, so
+#that its workers share it: a block a worker attaches to is then tracked
+#as the one the creating process made (and unlinks), not taken for a leak
+#of the worker's when it exits
+def njShareTracker():
+    if (shared_memory is not None) and (os.name == 'posix'):
+        resource_tracker.ensure_running()
+
+#attaches to shared memory created by another process, which stays
+#responsible for unlinking it
+def njAttachShared(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # Python 3.13+
+    except TypeError:
+        return shared_memory.SharedMemory(name=name) # tracked by the shared tracker, see njShareTracker
+
+#worker side of njDecodeParallel
+def njDecodeIntervals(task):
+    state, names, intervals = task
+    nj = NJ()
+    njInit(nj)
+    nj.mbwidth, scale, nj.batched, nj.qtab, nj.vlcspec, comps = state
+    nj.scale = scale
+    nj.bsize = 8 // scale
+    nj.ncoef = 64 if scale == 1 else nj.bsize * nj.bsize + 1
+    nj.zz = njZZScaled[scale]
+    nj.block = [0] * nj.ncoef
+    for i, spec in enumerate(nj.vlcspec):
+        if spec is not None:
+            nj.vlctab[i], nj.fasttab[i] = njGetVLCTables(spec)
+    nj.ncomp = len(comps)
+    shms = [njAttachShared(name) for name in names]
+    views = []
+    try:
+        for i in range(nj.ncomp):
+            c = nj.comp[i]
+            c.ssx, c.ssy, c.stride, c.qtsel, c.dctabsel, c.actabsel = comps[i]
+            views.append(shms[i].buf.cast('i') if nj.batched else shms[i].buf)
+            if nj.batched:
+                c.coefs = views[i]
+            else:
+                c.pixels = views[i]
+        for first, count, seg in intervals:
+            nj.seg = seg
+            nj.segpos = 0
+            nj.buf = 0
+            nj.bufbits = 0
+            for i in range(nj.ncomp):
                 nj.comp[i].dcpred = 0
-    nj.error = __NJ_FINISHED
+            njDecodeInterval(nj, first, count)
+    finally:
+        for i in range(nj.ncomp):
+            nj.comp[i].coefs = None
+            nj.comp[i].pixels = None
+        for view in views:
+            view.release()
+        for shm in shms:
+            shm.close()
 
 #if NJ_CHROMA_FILTER
+#The filtered samples are not clipped (unlike in the C version), so the
+#upsampled planes are signed 16 bit arrays instead of bytearrays.
 
 CF4A = -9
 CF4B = 111
@@ -755,7 +1472,7 @@ CF2B = -11
 
 def njUpsampleH(c):
     xmax = c.width - 3
-    out = [0] * ((c.width * c.height) << 1)
+    out = array('h', [0]) * ((c.width * c.height) << 1)
     lin = 0
     lout = 0
     y = c.height
@@ -780,7 +1497,7 @@ def njUpsampleV(c):
     w = c.width
     s1 = c.stride
     s2 = s1 + s1
-    out = [0] * ((c.width * c.height) << 1)
+    out = array('h', [0]) * ((c.width * c.height) << 1)
     for x in range(w):
         cin = x
         cout = x
@@ -809,6 +1526,54 @@ def njUpsampleV(c):
     c.stride = c.width
     c.pixels = out
 
+#the plane of c as a c.height x c.stride NumPy array, widened to int32 unless
+#only a view of the samples is wanted
+def njPlaneArray(c, widen=True):
+    dtype = numpy.int16 if isinstance(c.pixels, array) else numpy.uint8
+    p = numpy.frombuffer(c.pixels, dtype=dtype)[:c.height * c.stride]
+    p = p.reshape(c.height, c.stride)
+    return p.astype(numpy.int32) if widen else p
+
+#NumPy counterparts of njUpsampleH and njUpsampleV, with the same taps and
+#the same results. Like njUpsampleH, the right edge is taken from the end
+#of the stride, not of the width.
+def njUpsampleHBatch(c):
+    p = njPlaneArray(c)
+    w = c.width
+    s = c.stride
+    out = array('h', [0]) * ((c.width * c.height) << 1)
+    o = numpy.frombuffer(out, dtype=numpy.int16).reshape(c.height, w << 1)
+    o[:, 0] = ((139 * p[:, 0] + -11 * p[:, 1])+64)>>7
+    o[:, 1] = ((104 * p[:, 0] + 27 * p[:, 1] + -3 * p[:, 2])+64)>>7
+    o[:, 2] = ((28 * p[:, 0] + 109 * p[:, 1] + -9 * p[:, 2])+64)>>7
+    p0, p1, p2, p3 = p[:, 0:w - 3], p[:, 1:w - 2], p[:, 2:w - 1], p[:, 3:w]
+    o[:, 3:2 * w - 3:2] = ((-9 * p0 + 111 * p1 + 29 * p2 + -3 * p3)+64)>>7
+    o[:, 4:2 * w - 3:2] = ((-3 * p0 + 29 * p1 + 111 * p2 + -9 * p3)+64)>>7
+    o[:, -3] = ((28 * p[:, s - 1] + 109 * p[:, s - 2] + -9 * p[:, s - 3])+64)>>7
+    o[:, -2] = ((104 * p[:, s - 1] + 27 * p[:, s - 2] + -3 * p[:, s - 3])+64)>>7
+    o[:, -1] = ((139 * p[:, s - 1] + -11 * p[:, s - 2])+64)>>7
+    c.width <<= 1
+    c.stride = c.width
+    c.pixels = out
+
+def njUpsampleVBatch(c):
+    h = c.height
+    p = njPlaneArray(c)[:, :c.width]
+    out = array('h', [0]) * ((c.width * c.height) << 1)
+    o = numpy.frombuffer(out, dtype=numpy.int16).reshape(h << 1, c.width)
+    o[0] = ((139 * p[0] + -11 * p[1])+64)>>7
+    o[1] = ((104 * p[0] + 27 * p[1] + -3 * p[2])+64)>>7
+    o[2] = ((28 * p[0] + 109 * p[1] + -9 * p[2])+64)>>7
+    p0, p1, p2, p3 = p[0:h - 3], p[1:h - 2], p[2:h - 1], p[3:h]
+    o[3:2 * h - 3:2] = ((-9 * p0 + 111 * p1 + 29 * p2 + -3 * p3)+64)>>7
+    o[4:2 * h - 3:2] = ((-3 * p0 + 29 * p1 + 111 * p2 + -9 * p3)+64)>>7
+    o[-3] = ((28 * p[h - 1] + 109 * p[h - 2] + -9 * p[h - 3])+64)>>7
+    o[-2] = ((104 * p[h - 1] + 27 * p[h - 2] + -3 * p[h - 3])+64)>>7
+    o[-1] = ((139 * p[h - 1] + -11 * p[h - 2])+64)>>7
+    c.height <<= 1
+    c.stride = c.width
+    c.pixels = out
+
 #else
 
 # NJ_INLINE void njUpsample(nj_component_t* c) {
@@ -834,6 +1599,12 @@ def njUpsampleV(c):
 #endif
 
 def njConvert(nj):
+    for _ in njConvertSteps(nj):
+        pass
+
+#generator: yields after every upsampling pass and after every rows MCU
+#rows worth of RGB conversion
+def njConvertSteps(nj, rows=None):
     def njClip(x):
         if x < 0: return 0
         if x > 0xFF: return 0xFF
@@ -842,9 +1613,15 @@ def njConvert(nj):
         c = nj.comp[i]
         if NJ_CHROMA_FILTER:
             while ((c.width < nj.width) or (c.height < nj.height)):
-                if c.width < nj.width: njUpsampleH(c)
+                if c.width < nj.width:
+                    if nj.batched: njUpsampleHBatch(c)
+                    else: njUpsampleH(c)
+                    yield
                 if nj.error: return
-                if c.height < nj.height: njUpsampleV(c)
+                if c.height < nj.height:
+                    if nj.batched: njUpsampleVBatch(c)
+                    else: njUpsampleV(c)
+                    yield
                 if nj.error: return
         else:
             if ((c.width < nj.width) or (c.height < nj.height)):
@@ -852,13 +1629,16 @@ def njConvert(nj):
         if ((c.width < nj.width) or (c.height < nj.height)):
             raise Exception(NJ_INTERNAL_ERR)
             return
-    if nj.ncomp == 3:
+    if nj.ncomp == 3 and nj.batched:
+        njConvertBatch(nj)
+    elif nj.ncomp == 3:
         # convert to RGB
         prgb = 0
         py = 0
         pcb = 0
         pcr = 0
         yy = nj.height
+        step = (rows * nj.mbsizey // nj.scale) if rows else nj.height
 
         while yy:
             for x in range(nj.width):
@@ -877,18 +1657,35 @@ def njConvert(nj):
             pcb += nj.comp[1].stride
             pcr += nj.comp[2].stride
             yy -= 1
+            if not (yy % step):
+                yield
     elif (nj.comp[0].width != nj.comp[0].stride):
-        # grayscale -> only remove stride
-        # unsigned char *pin = &nj.comp[0].pixels[nj.comp[0].stride];
-        # unsigned char *pout = &nj.comp[0].pixels[nj.comp[0].width];
-        # int y;
-        # for (y = nj.comp[0].height - 1; y; --y) {
-        # njCopyMem(pout, pin, nj.comp[0].width);
-        # pin += nj.comp[0].stride;
-        # pout += nj.comp[0].width;
-        # }
-        # nj.comp[0].stride = nj.comp[0].width;
-        pass
+        # grayscale -> only remove stride, in place
+        c = nj.comp[0]
+        pin = c.stride
+        pout = c.width
+        for y in range(c.height - 1):
+            c.pixels[pout:pout + c.width] = c.pixels[pin:pin + c.width]
+            pin += c.stride
+            pout += c.width
+        c.stride = c.width
+
+#NumPy counterpart of the RGB conversion in njConvert, writing into nj.rgb
+#NJ_BATCH_ROWS MCU rows at a time
+def njConvertBatch(nj):
+    h = nj.height
+    w = nj.width
+    rgb = numpy.frombuffer(nj.rgb, dtype=numpy.uint8).reshape(h, w, 3)
+    planes = [njPlaneArray(nj.comp[i], False) for i in range(3)]
+    band = NJ_BATCH_ROWS * nj.mbsizey // nj.scale
+    for top in range(0, h, band):
+        bottom = min(top + band, h)
+        y = planes[0][top:bottom, :w].astype(numpy.int32) << 8
+        cb = planes[1][top:bottom, :w].astype(numpy.int32) - 128
+        cr = planes[2][top:bottom, :w].astype(numpy.int32) - 128
+        rgb[top:bottom, :, 0] = numpy.clip((y + 359 * cr + 128) >> 8, 0, 0xFF)
+        rgb[top:bottom, :, 1] = numpy.clip((y - 88 * cb - 183 * cr + 128) >> 8, 0, 0xFF)
+        rgb[top:bottom, :, 2] = numpy.clip((y + 454 * cb + 128) >> 8, 0, 0xFF)
 
 def njInit(nj):
     # njFillMem(&nj, 0, sizeof(nj_context_t));
@@ -897,8 +1694,28 @@ def njInit(nj):
 def njDone(nj):
     pass
 
-def njDecode(nj, jpeg, size):
+def njPickScale(width, height, target_width, target_height):
+    for scale in (8, 4, 2):
+        if ((((width + scale - 1) // scale) >= target_width) or
+            (((height + scale - 1) // scale) >= target_height)):
+            return scale
+    return 1
+
+def njDecode(nj, jpeg, size, scale=1, target=None, pool=None):
+    steps = njDecodeSteps(nj, jpeg, size, scale, target, pool, None)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as e:
+            return e.value
+
+def njDecodeSteps(nj, jpeg, size, scale=1, target=None, pool=None, rows=1):
     njDone(nj)
+    nj.orientation = 1
+    nj.thumbnail = None
+    if scale not in (1, 2, 4, 8): return NJ_UNSUPPORTED
+    nj.scale = scale
+    nj.target = target
     nj.spos = jpeg
     nj.pos = 0
     nj.size = size & 0x7FFFFFFF
@@ -914,26 +1731,65 @@ def njDecode(nj, jpeg, size):
         elif m == 0xC4: njDecodeDHT(nj)
         elif m == 0xDB: njDecodeDQT(nj)
         elif m == 0xDD: njDecodeDRI(nj)
-        elif m == 0xDA: njDecodeScan(nj)
+        elif m == 0xDA: yield from njDecodeScan(nj, pool, rows)
         elif m == 0xFE: njSkipMarker(nj)
+        elif m == 0xE1: njDecodeAPP1(nj)
         elif (m & 0xF0) == 0xE0:
             njSkipMarker(nj)
         else:
             return NJ_UNSUPPORTED
     if (nj.error != __NJ_FINISHED): return nj.error
     nj.error = NJ_OK
-    njConvert(nj)
+    yield from njConvertSteps(nj, rows)
     return nj.error
 
 
+def njProbe(nj, jpeg, size):
+    njDone(nj)
+    nj.orientation = 1
+    nj.thumbnail = None
+    nj.progressive = 0
+    nj.spos = jpeg
+    nj.pos = 0
+    nj.size = size & 0x7FFFFFFF
+    if (nj.size < 2): return NJ_NO_JPEG
+    if ((nj.spos[nj.pos] ^ 0xFF) | (nj.spos[nj.pos + 1] ^ 0xD8)): return NJ_NO_JPEG
+    njSkip(nj,2)
+    while True:
+        if ((nj.size < 2) or (nj.spos[nj.pos] != 0xFF)):
+            return NJ_SYNTAX_ERROR
+        njSkip(nj,2)
+        m = nj.spos[nj.pos - 1]
+        if ((m & 0xF0) == 0xC0) and (m not in (0xC4, 0xC8, 0xCC)):
+            # SOFn, the C4, C8 and CC markers are not frame headers
+            njDecodeLength(nj)
+            if (nj.length < 6):
+                return NJ_SYNTAX_ERROR
+            nj.height = njDecode16(nj, nj.pos + 1)
+            nj.width = njDecode16(nj, nj.pos + 3)
+            nj.ncomp = nj.spos[nj.pos + 5]
+            nj.progressive = int(m in (0xC2, 0xC6, 0xCA, 0xCE))
+            return NJ_OK
+        elif m == 0xE1: njDecodeAPP1(nj)
+        elif m in (0xD9, 0xDA): return NJ_SYNTAX_ERROR # no frame header
+        else: njSkipMarker(nj)
+
 def njGetWidth(nj):
     return nj.width
 def njGetHeight(nj):
     return nj.height
+def njGetScale(nj):
+    return nj.scale
 def njIsColor(nj):
     return (nj.ncomp != 1)
+def njIsProgressive(nj):
+    return nj.progressive
+def njGetOrientation(nj):
+    return nj.orientation
+def njGetThumbnail(nj):
+    return nj.thumbnail
 def njGetImage(nj):
-    return nj.comp[0].pixels if nj.ncomp == 1 else nj.rgb
+    return memoryview(nj.comp[0].pixels if nj.ncomp == 1 else nj.rgb)[:njGetImageSize(nj)]
 def njGetImageSize(nj):
     return nj.width * nj.height * nj.ncomp
 
@@ -182,6 +182,11 @@ import zlib
 # http://www.python.org/doc/2.4.4/lib/module-warnings.html
 import warnings
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 __all__ = ['Image', 'Reader', 'Writer', 'write_chunks', 'from_array']
 
@@ -203,6 +208,33 @@ def group(s, n):
     # http://www.python.org/doc/2.6/library/functions.html#zip
     return list(zip(*[iter(s)]*n))
 
+# Tables made by :func:`_unpack_table`, by bit depth.
+_unpack_tables = {}
+
+# Decompressed scanline data that :meth:`Reader.iterstraight` unfilters
+# at a time when numpy is available (between 16 and 256 rows).  The
+# wavefront arrays of :meth:`Reader.undo_filter_rows` take about three
+# times as much again, so a band holds about 4 times this while it is
+# undone.  Smaller bands save memory but cost time: each band is undone
+# in (columns + rows) numpy steps, whatever its height.
+FILTER_BAND_BYTES = 1 << 21
+
+def _unpack_table(bitdepth):
+    """A 256-entry list, giving for each byte value the ``bytes`` of
+    the `bitdepth`-bit samples packed into that byte, most significant
+    first.  Rows of 1, 2 and 4 bit samples are unpacked a byte at a
+    time by looking each byte up.
+    """
+
+    table = _unpack_tables.get(bitdepth)
+    if table is None:
+        mask = 2**bitdepth - 1
+        shifts = list(range(8 - bitdepth, -1, -bitdepth))
+        table = [bytes(bytearray([mask & (o >> s) for s in shifts]))
+          for o in range(256)]
+        _unpack_tables[bitdepth] = table
+    return table
+
 def isarray(x):
     """Same as ``isinstance(x, array)`` except on Python 2.2, where it
     always returns ``False``.  This helps PyPNG work on Python 2.2.
@@ -328,7 +360,8 @@ class Writer:
                  planes=None,
                  colormap=None,
                  maxval=None,
-                 chunk_limit=2**20):
+                 chunk_limit=2**20,
+                 strategy=None):
         """
         Create a PNG encoder object.
 
@@ -358,6 +391,8 @@ class Writer:
           Create an interlaced image.
         chunk_limit
           Write multiple ``IDAT`` chunks to save memory.
+        strategy
+          zlib compression strategy (for example ``zlib.Z_RLE``).
 
         The image size (in pixels) can be specified either by using the
         `width` and `height` arguments, or with the single `size`
@@ -444,6 +479,11 @@ class Writer:
         `chunk_limit` is used to limit the amount of memory used whilst
         compressing the image.  In order to avoid using large amounts of
         memory, multiple ``IDAT`` chunks may be created.
+
+        The `strategy` argument is passed to ``zlib.compressobj``;
+        ``None`` means the ``zlib`` default.  ``zlib.Z_RLE`` in
+        particular compresses filtered images of flat colour much
+        faster, and often no worse.
         """
 
         # At the moment the `planes` argument is ignored;
@@ -587,6 +627,7 @@ class Writer:
         self.bitdepth = int(bitdepth)
         self.compression = compression
         self.chunk_limit = chunk_limit
+        self.strategy = strategy
         self.interlace = bool(interlace)
         self.palette = check_palette(palette)
 
@@ -642,24 +683,10 @@ class Writer:
                   "rows supplied (%d) does not match height (%d)" %
                   (nrows, self.height))
 
-    def write_passes(self, outfile, rows, packed=False):
-        """
-        Write a PNG image to the output file.
-
-        Most users are expected to find the :meth:`write` or
-        :meth:`write_array` method more convenient.
-        
-        The rows should be given to this method in the order that
-        they appear in the output file.  For straightlaced images,
-        this is the usual top to bottom ordering, but for interlaced
-        images the rows should have already been interlaced before
-        passing them to this function.
-
-        `rows` should be an iterable that yields each row.  When
-        `packed` is ``False`` the rows should be in boxed row flat pixel
-        format; when `packed` is ``True`` each row should be a packed
-        sequence of bytes.
-
+    def write_preamble(self, outfile):
+        """Write the PNG signature and the chunks that come before the
+        ``IDAT`` chunks to the output file.  Used by the other
+        ``write_`` methods.
         """
 
         # http://www.w3.org/TR/PNG/#5PNG-file-signature
@@ -714,11 +741,43 @@ class Writer:
                 write_chunk(outfile, 'bKGD',
                             struct.pack("!3H", *self.background))
 
+    def make_compressor(self):
+        """Return a ``zlib`` compressor object for the ``IDAT`` data,
+        with the `compression` level and `strategy` given when creating
+        the instance.
+        """
+
         # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
-            compressor = zlib.compressobj(self.compression)
-        else:
-            compressor = zlib.compressobj()
+        level = self.compression
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        if self.strategy is None:
+            return zlib.compressobj(level)
+        return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS,
+          zlib.DEF_MEM_LEVEL, self.strategy)
+
+    def write_passes(self, outfile, rows, packed=False):
+        """
+        Write a PNG image to the output file.
+
+        Most users are expected to find the :meth:`write` or
+        :meth:`write_array` method more convenient.
+        
+        The rows should be given to this method in the order that
+        they appear in the output file.  For straightlaced images,
+        this is the usual top to bottom ordering, but for interlaced
+        images the rows should have already been interlaced before
+        passing them to this function.
+
+        `rows` should be an iterable that yields each row.  When
+        `packed` is ``False`` the rows should be in boxed row flat pixel
+        format; when `packed` is ``True`` each row should be a packed
+        sequence of bytes.
+
+        """
+
+        self.write_preamble(outfile)
+        compressor = self.make_compressor()
 
         # Choose an extend function based on the bitdepth.  The extend
         # function packs/decomposes the pixel values into bytes and
@@ -804,7 +863,7 @@ class Writer:
         if len(data):
             compressed = compressor.compress(tostring(data))
         else:
-            compressed = ''
+            compressed = strtobytes('')
         flushed = compressor.flush()
         if len(compressed) or len(flushed):
             # print >> sys.stderr, len(data), len(compressed), len(flushed)
@@ -824,6 +883,105 @@ class Writer:
         else:
             self.write_passes(outfile, self.array_scanlines(pixels))
 
+    def write_buffer(self, outfile, pixels):
+        """
+        Write a PNG image to the output file from `pixels`, the whole
+        image in flat row flat pixel format, one byte per value, in any
+        object supporting the buffer protocol (``bytes``, ``bytearray``,
+        ``mmap``, an ``array('B')``, a ``numpy`` array, ...).
+
+        For a straightlaced 8-bit image this is much faster than
+        :meth:`write_array`.  With ``numpy`` each row is filtered with
+        the filter type that gives the smallest sum of absolute values
+        (taking the filtered bytes as signed), the heuristic the PNG
+        specification suggests; without, rows are not filtered.  Rows
+        are compressed in blocks of about `chunk_limit` bytes, and
+        written in ``IDAT`` chunks of about that size.  Other images
+        are written by :meth:`write_array`.
+        """
+
+        pixels = memoryview(pixels).cast('B')
+        vpr = self.width * self.planes
+        if len(pixels) != vpr * self.height:
+            raise ValueError(
+              "pixels supplied (%d) does not match size (%d)" %
+              (len(pixels), vpr * self.height))
+        if self.interlace or self.bitdepth != 8 or self.rescale:
+            a = array('B')
+            a.frombytes(pixels)
+            return self.write_array(outfile, a)
+
+        self.write_preamble(outfile)
+        compressor = self.make_compressor()
+        # Rows per block, so that each is about chunk_limit bytes.
+        rows = max(1, self.chunk_limit // vpr)
+        previous = None
+        idat = []
+        size = 0
+        for y in range(0, self.height, rows):
+            block = pixels[y*vpr:(y+rows)*vpr]
+            if numpy is not None:
+                block = numpy.frombuffer(block, dtype=numpy.uint8)
+                block = block.reshape(-1, vpr)
+                data = self._filter_block(block, previous)
+                previous = block[-1]
+            else:
+                # Filter type 0 in front of each row.
+                data = bytearray(len(block) + len(block) // vpr)
+                for i in range(len(block) // vpr):
+                    data[i*(vpr+1)+1:(i+1)*(vpr+1)] = \
+                      block[i*vpr:(i+1)*vpr]
+            compressed = compressor.compress(data)
+            if compressed:
+                idat.append(compressed)
+                size += len(compressed)
+            if size >= self.chunk_limit:
+                write_chunk(outfile, 'IDAT', strtobytes('').join(idat))
+                idat = []
+                size = 0
+        idat.append(compressor.flush())
+        write_chunk(outfile, 'IDAT', strtobytes('').join(idat))
+        # http://www.w3.org/TR/PNG/#11IEND
+        write_chunk(outfile, 'IEND')
+
+    def _filter_block(self, block, previous):
+        """Helper used by :meth:`write_buffer`.  Filters each row of
+        `block`, a (rows, bytes per row) ``numpy`` array of bytes, with
+        every filter type and keeps the one with the smallest sum of
+        absolute values; returns the filtered rows, each preceded by
+        its filter type, as ``bytes``.  `previous` is the row before
+        the block, ``None`` for the first row of the image.
+        """
+
+        n,vpr = block.shape
+        # Filter offset, see :meth:`Reader.undo_filter`.
+        fo = self.planes
+        x = block.astype(numpy.int16)
+        # The bytes above (b), left (a) and above left (c), as in
+        # http://www.w3.org/TR/PNG/#9Filter-types ; 0 off the image.
+        b = numpy.zeros_like(x)
+        b[1:] = x[:-1]
+        if previous is not None:
+            b[0] = previous
+        a = numpy.zeros_like(x)
+        a[:, fo:] = x[:, :-fo]
+        c = numpy.zeros_like(x)
+        c[:, fo:] = b[:, :-fo]
+        pa = numpy.abs(b - c)
+        pb = numpy.abs(a - c)
+        pc = numpy.abs(a + b - 2*c)
+        paeth = numpy.where((pa <= pb) & (pa <= pc), a,
+          numpy.where(pb <= pc, b, c))
+        filtered = numpy.stack([x, x - a, x - b, x - ((a + b) >> 1),
+          x - paeth]).astype(numpy.uint8)
+        # Sum of absolute values, with the bytes taken as signed.
+        sad = numpy.minimum(filtered, 256 - filtered.astype(numpy.int16))
+        best = sad.sum(axis=2).argmin(axis=0)
+        out = numpy.empty((n, vpr + 1), dtype=numpy.uint8)
+        out[:, 0] = best
+        out[:, 1:] = filtered[best, numpy.arange(n)]
+        return out.tobytes()
+
     def write_packed(self, outfile, rows):
         """
         Write PNG file to `outfile`.  The pixel data comes from `rows`
@@ -1302,10 +1460,18 @@ class Image:
 
 class _readable:
     """
-    A simple file-like interface for strings and arrays.
+    A simple file-like interface for strings and arrays.  Anything
+    else supporting the buffer protocol (``bytes``, ``mmap``,
+    ``memoryview``) is read through a ``memoryview``, so that reads
+    return slices of it and nothing is copied.
     """
 
     def __init__(self, buf):
+        if not isarray(buf):
+            try:
+                buf = memoryview(buf)
+            except TypeError:
+                pass
         self.buf = buf
         self.offset = 0
 
@@ -1335,9 +1501,15 @@ class Reader:
         file
           A file-like object (object with a read() method).
         bytes
-          ``array`` or ``string`` with PNG data.
+          ``array`` or ``string`` with PNG data, or an ``mmap`` or
+          ``memoryview`` of it.  Chunks are read in place: ``IDAT``
+          data reaches the decompressor without being copied.
 
+        The optional keyword argument `check_crc` (default ``True``)
+        can be set to ``False`` to skip checking the CRC of each chunk,
+        for trusted input.
         """
+        self.check_crc = kw.pop('check_crc', True)
         if ((_guess is not None and len(kw) != 0) or
             (_guess is None and len(kw) != 1)):
             raise TypeError("Reader() takes exactly 1 argument")
@@ -1352,7 +1524,7 @@ class Reader:
         self.atchunk = None
 
         if _guess is not None:
-            if isarray(_guess):
+            if isarray(_guess) or isinstance(_guess, (bytes, memoryview)):
                 kw["bytes"] = _guess
             elif isinstance(_guess, str):
                 kw["filename"] = _guess
@@ -1380,6 +1552,10 @@ class Reader:
         out of file or finds the type specified by the argument.  Note
         that in general the order of chunks in PNGs is unspecified, so
         using `seek` can cause you to miss chunks.
+
+        When reading from a buffer (see the `bytes` argument of
+        :class:`Reader`) the data of an ``IDAT`` chunk is a
+        ``memoryview`` of the buffer rather than a copy.
         """
 
         self.validate_signature()
@@ -1399,6 +1575,11 @@ class Reader:
                 raise ValueError('Chunk %s too short for checksum.', tag)
             if seek and type != seek:
                 continue
+            if isinstance(data, memoryview) and type != 'IDAT':
+                # Other chunks are small, and are kept as metadata.
+                data = data.tobytes()
+            if not self.check_crc:
+                return type, data
             verify = zlib.crc32(strtobytes(type))
             verify = zlib.crc32(data, verify)
             # Whether the output from zlib.crc32 is signed or not varies
@@ -1450,7 +1631,10 @@ class Reader:
         # existing sequence.  *sigh*
         # If we fill the result with scanline, then this allows a
         # micro-optimisation in the "null" and "sub" cases.
-        result = array('B', scanline)
+        # `frombytes` copies any buffer (including a memoryview) in one
+        # go, where the constructor would iterate over it.
+        result = array('B')
+        result.frombytes(scanline)
 
         if filter_type == 0:
             # And here, we _rely_ on filling the result with scanline,
@@ -1540,57 +1724,307 @@ class Reader:
         (None, sub, up, average, paeth)[filter_type]()
         return result
 
-    def deinterlace(self, raw):
+    def undo_filter_fast(self, filter_type, scanline, previous):
+        """Same as :meth:`undo_filter`, and giving byte for byte the
+        same result, but faster.  The "up" and "sub" filters are undone
+        for the whole row at once using ``numpy`` (if it cannot be
+        imported, :meth:`undo_filter` does these).  "average" and
+        "paeth" are undone one channel at a time: each channel is a
+        recurrence over the pixels of the row, which runs as a tight
+        loop over the channel's bytes.
+        """
+
+        if (filter_type not in (1,2,3,4) or
+          (filter_type in (1,2) and numpy is None)):
+            return self.undo_filter(filter_type, scanline, previous)
+
+        # Filter unit, see :meth:`undo_filter`.  Rows always hold a
+        # whole number of filter units.
+        fu = max(1, self.psize)
+        result = array('B')
+        if not previous:
+            previous = bytes(len(scanline))
+
+        if filter_type == 1:
+            # Sub: a running sum, mod 256, of each channel.
+            x = numpy.frombuffer(scanline, dtype=numpy.uint8)
+            result.frombytes(numpy.cumsum(x.reshape(-1, fu), axis=0,
+              dtype=numpy.uint8))
+            return result
+        if filter_type == 2:
+            # Up: uint8 addition wraps around mod 256 by itself.
+            x = numpy.frombuffer(scanline, dtype=numpy.uint8)
+            b = numpy.frombuffer(previous, dtype=numpy.uint8)
+            result.frombytes(x + b)
+            return result
+
+        out = bytearray(len(scanline))
+        for i in range(fu):
+            recon = []
+            append = recon.append
+            # a, b and c are the bytes to the left, above and above
+            # left, as in the spec; a and c are 0 for the first pixel.
+            a = c = 0
+            if filter_type == 3:
+                for x, b in zip(scanline[i::fu], previous[i::fu]):
+                    a = (x + ((a + b) >> 1)) & 0xff
+                    append(a)
+            else:
+                for x, b in zip(scanline[i::fu], previous[i::fu]):
+                    # With p = a + b - c:  p - a = b - c,  p - b = a - c
+                    # and p - c = (a - c) + (b - c).
+                    pa = b - c
+                    pb = a - c
+                    pc = abs(pa + pb)
+                    pa = abs(pa)
+                    pb = abs(pb)
+                    if pa > pb or pa > pc:
+                        a = b if pb <= pc else c
+                    a = (x + a) & 0xff
+                    c = b
+                    append(a)
+            out[i::fu] = bytes(recon)
+        result.frombytes(out)
+        return result
+
+    def undo_filter_rows(self, data, row_bytes, previous):
+        """Undo the filters of a run of scanlines, and return a list of
+        the reconstructed scanlines, as :meth:`undo_filter_fast` would
+        give them one at a time.  `data` holds the scanlines, each
+        `row_bytes` long with its filter type byte in front of it;
+        `previous` is the reconstructed scanline before them, or
+        ``None`` at the top of the image (or interlace pass).
+
+        "average" and "paeth" are a recurrence along the row, so a row
+        cannot be undone all at once.  But a byte depends only on the
+        bytes to its left, above and above left, so each anti-diagonal
+        of the run depends only on the two before it.  When ``numpy``
+        can be imported and at least half the rows use these filters,
+        the run is undone a diagonal at a time, all its rows in step;
+        otherwise a row at a time.
+        """
+
+        rows = len(data) // (row_bytes + 1)
+        types = bytearray(data[::row_bytes+1])
+        slow = types.count(3) + types.count(4)
+        if (numpy is None or rows < 16 or 2*slow < rows or
+          max(types) > 4):
+            result = []
+            for i in range(0, len(data), row_bytes+1):
+                previous = self.undo_filter_fast(data[i],
+                  data[i+1:i+1+row_bytes], previous)
+                result.append(previous)
+            return result
+
+        # Filter unit, see :meth:`undo_filter`.
+        fu = max(1, self.psize)
+        units = row_bytes // fu
+        x = numpy.frombuffer(data, dtype=numpy.uint8).reshape(
+          rows, row_bytes + 1)
+        # Skewed so that diagonal d (unit u of row r, where d = r + u)
+        # is x[d+2] and recon[d+2]; recon[:, 0] is `previous`, a
+        # diagonal behind.  Units left of a row's start stay 0, as
+        # the left and above left neighbours of its first unit are.
+        skewed = numpy.zeros((units + rows + 2, rows, fu), numpy.uint8)
+        for r in range(rows):
+            skewed[r+2:r+2+units, r] = x[r, 1:].reshape(units, fu)
+        recon = numpy.zeros((units + rows + 2, rows + 1, fu), numpy.int16)
+        if previous:
+            recon[1:units+1, 0] = numpy.frombuffer(previous,
+              dtype=numpy.uint8).reshape(units, fu)
+        types = x[:, :1]
+        paeth = 4 in types
+        masks = [(t, numpy.broadcast_to(types == t, (rows, fu)))
+          for t in (0,1,2,3) if t in set(types.ravel().tolist())]
+        pa = numpy.empty((rows, fu), numpy.int16)
+        pb = numpy.empty_like(pa)
+        pc = numpy.empty_like(pa)
+        pred = numpy.empty_like(pa)
+        ma = numpy.empty((rows, fu), bool)
+        mb = numpy.empty_like(ma)
+        for i in range(units + rows - 1):
+            # The rows that have a unit on this diagonal.
+            lo,hi = max(0, i - units + 1),min(rows, i + 1)
+            a = recon[i+1, lo+1:hi+1]
+            b = recon[i+1, lo:hi]
+            c = recon[i, lo:hi]
+            p = pred[:hi-lo]
+            if paeth:
+                # Paeth, as in :meth:`undo_filter_fast`.
+                pa_,pb_,pc_ = pa[:hi-lo],pb[:hi-lo],pc[:hi-lo]
+                numpy.subtract(b, c, out=pa_)
+                numpy.abs(pa_, out=pa_)
+                numpy.subtract(a, c, out=pb_)
+                numpy.abs(pb_, out=pb_)
+                numpy.add(a, b, out=pc_)
+                numpy.subtract(pc_, c, out=pc_)
+                numpy.subtract(pc_, c, out=pc_)
+                numpy.abs(pc_, out=pc_)
+                numpy.less_equal(pb_, pc_, out=mb[:hi-lo])
+                numpy.copyto(p, c)
+                numpy.copyto(p, b, where=mb[:hi-lo])
+                numpy.less_equal(pa_, pb_, out=ma[:hi-lo])
+                ma[:hi-lo] &= pa_ <= pc_
+                numpy.copyto(p, a, where=ma[:hi-lo])
+            for t,mask in masks:
+                predictor = (0, a, b, (a + b) >> 1)[t]
+                numpy.copyto(p, predictor, where=mask[lo:hi])
+            out = recon[i+2, lo+1:hi+1]
+            numpy.add(skewed[i+2, lo:hi], p, out=out)
+            numpy.bitwise_and(out, 0xff, out=out)
+        result = []
+        for r in range(rows):
+            line = array('B')
+            line.frombytes(recon[r+2:r+2+units, r+1].astype(numpy.uint8))
+            result.append(line)
+        return result
+
+    def deinterlace(self, raw, preview=None):
         """
         Read raw pixel data, undo filters, deinterlace, and flatten.
         Return in flat row flat pixel format.
+
+        If `preview` is 1, 3 or 5 only that many passes are read (so
+        `raw` need hold no more than their data), and what is returned
+        is a preview, see :meth:`iterdeinterlace`.
         """
 
-        # print >> sys.stderr, ("Reading interlaced, w=%s, r=%s, planes=%s," +
-        #     " bpp=%s") % (self.width, self.height, self.planes, self.bps)
+        previews = ()
+        if preview:
+            previews = (preview,)
+        for passes,pixels in self.iterdeinterlace([raw], previews):
+            return pixels
+
+    def iterdeinterlace(self, raw, previews=(1,3,5), replicate=True,
+      steps=None):
+        """Iterator that undoes filters and deinterlaces, yielding
+        (*passes*, *pixels*) pairs, where *pixels* is a whole image in
+        flat row flat pixel format.  `raw` should be an iterable that
+        yields the decompressed data, which is read only as far as the
+        passes so far need.
+
+        After each of the passes 1, 3 and 5 that is in `previews` a
+        preview is yielded: each pixel decoded so far stands in for the
+        block it is the top left of (8 by 8 pixels after pass 1, 4 by 4
+        after pass 3, 2 by 2 after pass 5).  The finished image comes
+        last, with *passes* 7.
+
+        With `replicate` false a preview is not filled in: it is the
+        result array itself, with only the pixels at multiples of 8, 4
+        or 2 (across and down) decoded so far, and later passes write
+        over it.
+
+        With `steps` a pass is read and unfiltered `steps` scanlines at
+        a time, and (*passes*, ``None``) is yielded after each of them
+        but the last, so that a caller running from an event loop can
+        get on with other work during the long passes 6 and 7.
+        """
+
+        width,height,planes = self.width,self.height,self.planes
         # Values per row (of the target image)
-        vpr = self.width * self.planes
+        vpr = width * planes
 
         # Make a result array, and make it big enough.  Interleaving
         # writes to the output array randomly (well, not quite), so the
         # entire output array must be in memory.
         fmt = 'BH'[self.bitdepth > 8]
-        a = array(fmt, [0]*vpr*self.height)
-        source_offset = 0
-
-        for xstart, ystart, xstep, ystep in _adam7:
-            # print >> sys.stderr, "Adam7: start=%s,%s step=%s,%s" % (
-            #     xstart, ystart, xstep, ystep)
-            if xstart >= self.width:
-                continue
-            # The previous (reconstructed) scanline.  None at the
-            # beginning of a pass to indicate that there is no previous
-            # line.
-            recon = None
-            # Pixels per row (reduced pass image)
-            ppr = int(math.ceil((self.width-xstart)/float(xstep)))
-            # Row size in bytes for this pass.
-            row_size = int(math.ceil(self.psize * ppr))
-            for y in range(ystart, self.height, ystep):
-                filter_type = raw[source_offset]
-                source_offset += 1
-                scanline = raw[source_offset:source_offset+row_size]
-                source_offset += row_size
-                recon = self.undo_filter(filter_type, scanline, recon)
+        a = array(fmt, [0]) * (vpr * height)
+        if numpy is not None:
+            # A view of the result, indexed by row, column and plane.
+            image = numpy.frombuffer(a, dtype=fmt).reshape(
+              height, width, planes)
+        raw = iter(raw)
+        data = bytearray()
+
+        for passes,(xstart, ystart, xstep, ystep) in enumerate(_adam7):
+            passes += 1
+            if xstart < width and ystart < height:
+                # Pixels per row (reduced pass image)
+                ppr = int(math.ceil((width-xstart)/float(xstep)))
+                # Row size in bytes for this pass.
+                row_size = int(math.ceil(self.psize * ppr))
+                rows = len(range(ystart, height, ystep))
+                # The scanlines of this pass, filter bytes removed.
+                lines = array('B')
+                recon = None
+                done = 0
+                while done < rows:
+                    if done:
+                        yield passes,None
+                    n = rows - done
+                    if steps:
+                        n = min(n, steps)
+                    size = n * (1 + row_size)
+                    while len(data) < size:
+                        try:
+                            data.extend(next(raw))
+                        except StopIteration:
+                            raise FormatError(
+                              'Not enough data for interlace pass %d.'
+                              % passes)
+                    with memoryview(data) as view:
+                        with view[:size] as scanlines:
+                            for recon in self.undo_filter_rows(scanlines,
+                              row_size, recon):
+                                lines.extend(recon)
+                    del data[:size]
+                    done += n
                 # Convert so that there is one element per pixel value
-                flat = self.serialtoflat(recon, ppr)
-                if xstep == 1:
-                    assert xstart == 0
-                    offset = y * vpr
-                    a[offset:offset+vpr] = flat
+                if self.bitdepth == 16:
+                    flat = array('H', lines.tobytes())
+                    if sys.byteorder == 'little':
+                        flat.byteswap()
+                elif self.bitdepth < 8:
+                    flat = self.serialtoflat(lines, ppr)
                 else:
-                    offset = y * vpr + xstart * self.planes
-                    end_offset = (y+1) * vpr
-                    skip = self.planes * xstep
-                    for i in range(self.planes):
-                        a[offset+i:end_offset:skip] = \
-                            flat[i::self.planes]
-        return a
+                    flat = lines
+                if numpy is not None:
+                    # Scatter the whole pass at once.
+                    image[ystart::ystep, xstart::xstep] = numpy.frombuffer(
+                      flat, dtype=fmt).reshape(rows, ppr, planes)
+                else:
+                    vpp = ppr * planes
+                    skip = planes * xstep
+                    for i,y in enumerate(range(ystart, height, ystep)):
+                        offset = y * vpr + xstart * planes
+                        end_offset = (y+1) * vpr
+                        row = flat[i*vpp:(i+1)*vpp]
+                        for j in range(planes):
+                            a[offset+j:end_offset:skip] = row[j::planes]
+            if passes == 7:
+                yield passes,a
+            elif passes in previews and not replicate:
+                yield passes,a
+            elif passes in previews:
+                yield passes,self._replicate(a, (0,8,0,4,0,2)[passes])
+
+    def _replicate(self, a, step):
+        """Helper used by :meth:`iterdeinterlace`.  A copy of the image
+        `a`, in flat row flat pixel format, with the pixel at each
+        multiple of `step` across and down copied over the `step` by
+        `step` block below and to the right of it.
+        """
+
+        width,height,planes = self.width,self.height,self.planes
+        vpr = width * planes
+        if numpy is not None:
+            image = numpy.frombuffer(a, dtype=a.typecode).reshape(
+              height, width, planes)
+            image = image[::step, ::step].repeat(step, axis=0)
+            image = image.repeat(step, axis=1)[:height, :width]
+            out = array(a.typecode)
+            out.frombytes(image.tobytes())
+            return out
+        out = array(a.typecode)
+        for y in range(0, height, step):
+            source = a[y*vpr:(y+1)*vpr]
+            row = array(a.typecode)
+            for x in range(0, vpr, step * planes):
+                row.extend(source[x:x+planes] * step)
+            row = row[:vpr]
+            for i in range(min(step, height - y)):
+                out.extend(row)
+        return out
 
     def iterboxed(self, rows):
         """Iterator that yields each scanline in boxed row flat pixel
@@ -1608,15 +2042,12 @@ class Reader:
                 raw = tostring(raw)
                 return array('H', struct.unpack('!%dH' % (len(raw)//2), raw))
             assert self.bitdepth < 8
-            width = self.width
-            # Samples per byte
-            spb = 8//self.bitdepth
             out = array('B')
-            mask = 2**self.bitdepth - 1
-            shifts = list(map(self.bitdepth.__mul__, reversed(list(range(spb)))))
-            for o in raw:
-                out.extend([mask&(o>>i) for i in shifts])
-            return out[:width]
+            out.frombytes(strtobytes('').join(map(table.__getitem__, raw)))
+            return out[:self.width]
+
+        if self.bitdepth < 8:
+            table = _unpack_table(self.bitdepth)
 
         return map(asvalues, rows)
 
@@ -1636,37 +2067,61 @@ class Reader:
             width = self.width
         # Samples per byte
         spb = 8//self.bitdepth
+        table = _unpack_table(self.bitdepth)
+        join = strtobytes('').join
+        # Each row starts on a fresh byte.
+        row_bytes = int(math.ceil(width / float(spb)))
         out = array('B')
-        mask = 2**self.bitdepth - 1
-        shifts = list(map(self.bitdepth.__mul__, reversed(list(range(spb)))))
-        l = width
-        for o in bytes:
-            out.extend([(mask&(o>>s)) for s in shifts][:l])
-            l -= spb
-            if l <= 0:
-                l = width
+        for i in range(0, len(bytes), row_bytes):
+            row = join(map(table.__getitem__, bytes[i:i+row_bytes]))
+            out.frombytes(row[:width])
         return out
 
     def iterstraight(self, raw):
         """Iterator that undoes the effect of filtering, and yields each
         row in serialised format (as a sequence of bytes).  Assumes input
         is straightlaced.  `raw` should be an iterable that yields the
-        raw bytes in chunks of arbitrary size."""
+        raw bytes in chunks of arbitrary size.
+
+        Without numpy only the current and previous scanlines are
+        held.  With numpy a band of rows is undone at once, and about 4
+        times :data:`FILTER_BAND_BYTES` is held while it is (the band
+        itself is never less than 16 rows)."""
 
         # length of row, in bytes
         rb = self.row_bytes
-        a = array('B')
+        # With numpy, rows are undone a band at a time (see
+        # :meth:`undo_filter_rows`), FILTER_BAND_BYTES of decompressed
+        # data, so that the memory held does not grow with the image.
+        band = 1
+        if numpy is not None:
+            band = max(16, min(256, FILTER_BAND_BYTES // (rb + 1)))
+        a = bytearray()
         # The previous (reconstructed) scanline.  None indicates first
         # line of image.
         recon = None
-        for some in raw:
-            a.extend(some)
-            while len(a) >= rb + 1:
-                filter_type = a[0]
-                scanline = a[1:rb+1]
-                del a[:rb+1]
-                recon = self.undo_filter(filter_type, scanline, recon)
-                yield recon
+        for some in itertools.chain(raw, [None]):
+            if some is None:
+                # The end of the data: what is left is the last band.
+                band = 1
+            else:
+                a.extend(some)
+            # Rows are read in place, by offset, and the bytes they used
+            # are dropped once per band rather than once per row.
+            start = 0
+            with memoryview(a) as view:
+                while len(a) - start >= band * (rb + 1):
+                    rows = (len(a) - start) // (rb + 1)
+                    if band > 1:
+                        rows = band
+                    end = start + rows * (rb + 1)
+                    # Released before `a` is resized.
+                    with view[start:end] as scanlines:
+                        lines = self.undo_filter_rows(scanlines, rb, recon)
+                    start = end
+                    for recon in lines:
+                        yield recon
+            del a[:start]
         if len(a) != 0:
             # :file:format We get here with a file format error: when the
             # available bytes (after decompressing) do not pack into exact
@@ -1846,6 +2301,49 @@ class Reader:
                 not self.colormap and len(data) != self.planes):
                 raise FormatError("sBIT chunk has incorrect length.")
 
+    def iteridat(self):
+        """Iterator that yields all the ``IDAT`` chunks as strings."""
+        while True:
+            try:
+                type, data = self.chunk()
+            except ValueError as e:
+                raise ChunkError(e.args[0])
+            if type == 'IEND':
+                # http://www.w3.org/TR/PNG/#11IEND
+                break
+            if type != 'IDAT':
+                continue
+            # type == 'IDAT'
+            # http://www.w3.org/TR/PNG/#11IDAT
+            if self.colormap and not self.plte:
+                warnings.warn("PLTE chunk is required before IDAT chunk")
+            yield data
+
+    def iterdecomp(self, idat):
+        """Iterator that yields decompressed strings.  `idat` should
+        be an iterator that yields the ``IDAT`` chunk data.
+        """
+
+        # Output is produced a few rows at a time (but not in
+        # pieces so small that the calls dominate), however large
+        # the IDAT chunks are.
+        max_length = max(4 * (self.row_bytes + 1), 2**16)
+        d = zlib.decompressobj()
+        # Each IDAT chunk is passed to the decompressor, at most
+        # 64 KiB at a time so that the unconsumed tail it keeps
+        # copying stays small however large the chunk is, then any
+        # remaining state is decompressed out.
+        for chunk in idat:
+            chunk = memoryview(chunk)
+            for i in range(0, len(chunk), 2**16):
+                data = chunk[i:i+2**16]
+                while data:
+                    out = d.decompress(data, max_length)
+                    data = d.unconsumed_tail
+                    if out:
+                        yield out
+        yield d.flush()
+
     def read(self):
         """
         Read the PNG file and decode it.  Returns (`width`, `height`,
@@ -1856,51 +2354,14 @@ class Reader:
         `pixels` are returned in boxed row flat pixel format.
         """
 
-        def iteridat():
-            """Iterator that yields all the ``IDAT`` chunks as strings."""
-            while True:
-                try:
-                    type, data = self.chunk()
-                except ValueError as e:
-                    raise ChunkError(e.args[0])
-                if type == 'IEND':
-                    # http://www.w3.org/TR/PNG/#11IEND
-                    break
-                if type != 'IDAT':
-                    continue
-                # type == 'IDAT'
-                # http://www.w3.org/TR/PNG/#11IDAT
-                if self.colormap and not self.plte:
-                    warnings.warn("PLTE chunk is required before IDAT chunk")
-                yield data
-
-        def iterdecomp(idat):
-            """Iterator that yields decompressed strings.  `idat` should
-            be an iterator that yields the ``IDAT`` chunk data.
-            """
-
-            # Currently, with no max_length paramter to decompress, this
-            # routine will do one yield per IDAT chunk.  So not very
-            # incremental.
-            d = zlib.decompressobj()
-            # Each IDAT chunk is passed to the decompressor, then any
-            # remaining state is decompressed out.
-            for data in idat:
-                # :todo: add a max_length argument here to limit output
-                # size.
-                yield array('B', d.decompress(data))
-            yield array('B', d.flush())
-
         self.preamble()
-        raw = iterdecomp(iteridat())
+        raw = self.iterdecomp(self.iteridat())
 
         if self.interlace:
-            raw = array('B', itertools.chain(*raw))
-            arraycode = 'BH'[self.bitdepth>8]
-            # Like :meth:`group` but producing an array.array object for
-            # each row.
-            pixels = map(lambda *row: array(arraycode, row),
-                       *[iter(self.deinterlace(raw))]*self.width*self.planes)
+            a = self.deinterlace(strtobytes('').join(raw))
+            vpr = self.width * self.planes
+            # An array.array object for each row.
+            pixels = [a[i:i+vpr] for i in range(0, len(a), vpr)]
         else:
             pixels = self.iterboxed(self.iterstraight(raw))
         meta = dict()
@@ -1950,7 +2411,7 @@ class Reader:
                 "Required PLTE chunk is missing in colour type 3 image.")
         plte = group(array('B', self.plte), 3)
         if self.trns or alpha == 'force':
-            trns = array('B', self.trns or '')
+            trns = array('B', self.trns or [])
             trns.extend([255]*(len(plte)-len(trns)))
             plte = list(map(operator.add, plte, group(trns, 1)))
         return plte
@@ -2039,26 +2500,37 @@ class Reader:
                     yield array(typecode,
                       itertools.chain(*list(map(operator.add, row, opa))))
             pixels = itertrns(pixels)
-        targetbitdepth = None
-        if self.sbit:
-            sbit = struct.unpack('%dB' % len(self.sbit), self.sbit)
-            targetbitdepth = max(sbit)
-            if targetbitdepth > meta['bitdepth']:
-                raise Error('sBIT chunk %r exceeds bitdepth %d' %
-                    (sbit,self.bitdepth))
-            if min(sbit) <= 0:
-                raise Error('sBIT chunk %r has a 0-entry' % sbit)
-            if targetbitdepth == meta['bitdepth']:
-                targetbitdepth = None
+        targetbitdepth = self._sbit_bitdepth(meta['bitdepth'])
         if targetbitdepth:
             shift = meta['bitdepth'] - targetbitdepth
             meta['bitdepth'] = targetbitdepth
+            typecode = 'BH'[targetbitdepth > 8]
             def itershift(pixels):
                 for row in pixels:
-                    yield list(map(shift.__rrshift__, row))
+                    yield array(typecode, map(shift.__rrshift__, row))
             pixels = itershift(pixels)
         return x,y,pixels,meta
 
+    def _sbit_bitdepth(self, bitdepth):
+        """The bit depth that the ``sBIT`` chunk reduces samples of
+        `bitdepth` bits to, or ``None`` if there is no ``sBIT`` chunk
+        or it does not reduce them.  Helper used by :meth:`asDirect` and
+        :meth:`iterRGB8Over`.
+        """
+
+        if not self.sbit:
+            return None
+        sbit = struct.unpack('%dB' % len(self.sbit), self.sbit)
+        targetbitdepth = max(sbit)
+        if targetbitdepth > bitdepth:
+            raise Error('sBIT chunk %r exceeds bitdepth %d' %
+                (sbit,self.bitdepth))
+        if min(sbit) <= 0:
+            raise Error('sBIT chunk %r has a 0-entry' % sbit)
+        if targetbitdepth == bitdepth:
+            return None
+        return targetbitdepth
+
     def asFloat(self, maxval=1.0):
         """Return image pixels as per :meth:`asDirect` method, but scale
         all pixel values to be floating point values between 0.0 and
@@ -2199,6 +2671,381 @@ class Reader:
         meta['greyscale'] = False
         return width,height,convert(),meta
 
+    def asRGB8Over(self, background=(255,255,255)):
+        """Return the image as 8-bit RGB pixels, with any transparency
+        (an alpha channel or a ``tRNS`` chunk) composited over the
+        `background` colour, an (*r*, *g*, *b*) triple of 8-bit values.
+        Images of any colour type and bit depth are converted, rescaled
+        as by :meth:`asRGB8`.
+
+        This function returns a 4-tuple:
+        (*width*, *height*, *pixels*, *metadata*).
+        Unlike the other methods *pixels* is a single ``bytearray``
+        holding the whole image, ``3 * width`` bytes per row, top row
+        first.  When ``numpy`` can be imported whole blocks of rows are
+        converted at once, using lookup tables for palettes and for
+        rescaling.
+        """
+
+        width,height,bands,meta = self.iterRGB8Over(background)
+        pixels = bytearray(width * height * 3)
+        i = 0
+        for band in bands:
+            pixels[i:i+len(band)] = band
+            i += len(band)
+        return width,height,pixels,meta
+
+    def iterRGB8Over(self, background=(255,255,255), rows=16):
+        """Like :meth:`asRGB8Over`, but *pixels* is an iterator that
+        yields `rows` rows at a time (fewer for the last band) as one
+        ``bytes`` object.  Interlaced images are decoded in full before
+        the first band is yielded.
+        """
+
+        self.preamble()
+        # The numpy lookup is quicker for 8-bit indexes, but not when
+        # they have to be unpacked first.
+        if (self.colormap and not self.interlace and
+          (numpy is None or self.bitdepth < 8)):
+            return self._iter_rgb8_over_indexed(background, rows)
+        if numpy is None:
+            return self._iter_rgb8_over_python(background, rows)
+        return self._iter_rgb8_over_numpy(background, rows)
+
+    def iterRGB8OverPreviews(self, background=(255,255,255),
+      previews=(1,3,5), steps=None):
+        """Like :meth:`asRGB8Over`, but an iterator.  For an interlaced
+        image it yields a preview after each of the passes in
+        `previews` (see :meth:`iterdeinterlace`), and the finished
+        image last; all are 4-tuples like the one :meth:`asRGB8Over`
+        returns.  A preview is just the pixels decoded so far, every
+        8th, 4th or 2nd across and down, so it is an image of its own
+        (1/8, 1/4 or 1/2 the size); its metadata has a ``preview``
+        entry, the number of passes it shows.  With `steps` it also
+        yields ``None`` after each `steps` scanlines of a pass (see
+        :meth:`iterdeinterlace`).  Straightlaced images, and all images
+        when ``numpy`` cannot be imported, yield only the finished
+        image.
+        """
+
+        self.preamble()
+        if not self.interlace or numpy is None:
+            yield self.asRGB8Over(background)
+            return
+        convert = self._rgb8_over_converter(background)
+        raw = self.iterdecomp(self.iteridat())
+        for passes,values in self.iterdeinterlace(raw, previews,
+          replicate=False, steps=steps):
+            if values is None:
+                yield None
+                continue
+            values = numpy.frombuffer(values, dtype=values.typecode)
+            values = values.reshape(self.height, self.width, self.planes)
+            meta = self._rgb8_over_meta()
+            if passes < 7:
+                step = (0,8,0,4,0,2)[passes]
+                values = values[::step, ::step]
+                meta['preview'] = passes
+            height,width = values.shape[:2]
+            meta['size'] = (width, height)
+            pixels = bytearray(convert(values.reshape(height, -1)))
+            yield width,height,pixels,meta
+
+    def iterRGB8OverSampled(self, background=(255,255,255), columns=None,
+      rows=None):
+        """Like :meth:`iterRGB8Over`, but only for the pixels at the
+        indexes in `columns` of each row whose index is in `rows` (both
+        ascending sequences, which may repeat an index; ``None`` means
+        all of them), as for nearest neighbour resizing.  The iterator
+        yields one ``bytes`` object per index in `rows`.
+
+        Straightlaced images are streamed: rows are decompressed,
+        unfiltered and sampled a band at a time, so what is held
+        besides the output does not grow with the image: with numpy
+        it is about 4 times :data:`FILTER_BAND_BYTES` (8 MiB), without
+        it a couple of rows (see :meth:`iterstraight`).  Interlaced
+        images are decoded in full first.
+        """
+
+        self.preamble()
+        if columns is None:
+            columns = range(self.width)
+        if rows is None:
+            rows = range(self.height)
+        if numpy is None:
+            return self._iter_rgb8_over_sampled_python(background,
+              columns, rows)
+        return self._iter_rgb8_over_sampled_numpy(background, columns, rows)
+
+    def _iter_rgb8_over_sampled_python(self, background, columns, rows):
+        """Helper used by :meth:`iterRGB8OverSampled` when ``numpy``
+        cannot be imported: :meth:`iterRGB8Over` streams the rows one
+        at a time, and the sampled pixels are picked out of them.
+        """
+
+        width,height,bands,meta = self.iterRGB8Over(background, 1)
+        join = strtobytes('').join
+        y = -1
+        for want in rows:
+            while y < want:
+                row = next(bands)
+                y += 1
+            yield join([row[3*x:3*x+3] for x in columns])
+
+    def _iter_rgb8_over_sampled_numpy(self, background, columns, rows):
+        """Helper used by :meth:`iterRGB8OverSampled` with ``numpy``:
+        the sampled pixels of each row are picked out of its sample
+        values and converted by :meth:`_rgb8_over_converter`.
+        """
+
+        convert = self._rgb8_over_converter(background)
+        planes = self.planes
+        columns = numpy.asarray(columns, dtype=numpy.intp)
+        raw = self.iterdecomp(self.iteridat())
+        if self.interlace:
+            values = self.deinterlace(strtobytes('').join(raw))
+            values = numpy.frombuffer(values, dtype=values.typecode)
+            values = values.reshape(self.height, self.width, planes)
+            for y in rows:
+                yield convert(values[y, columns].reshape(1, -1))
+            return
+        lines = self.iterstraight(raw)
+        y = -1
+        for want in rows:
+            while y < want:
+                line = next(lines)
+                y += 1
+            values = self._unpack_lines([line]).reshape(-1, planes)
+            yield convert(values[columns].reshape(1, -1))
+
+    def _rgb8_over_meta(self):
+        """Helper used by :meth:`iterRGB8Over` to make the metadata of
+        the composited image.
+        """
+
+        meta = dict(greyscale=False, alpha=False, planes=3, bitdepth=8,
+          interlace=self.interlace, size=(self.width, self.height))
+        if getattr(self, 'gamma', None) is not None:
+            meta['gamma'] = self.gamma
+        return meta
+
+    def _rgb8_rescale(self, values, bitdepth):
+        """Helper used by :meth:`iterRGB8Over`.  Returns a list of
+        `values`, samples of `bitdepth` bits, rescaled to 8 bits;
+        honouring the ``sBIT`` chunk like :meth:`asDirect` and rounding
+        like :meth:`asRGB8`.
+        """
+
+        targetbitdepth = self._sbit_bitdepth(bitdepth) or bitdepth
+        shift = bitdepth - targetbitdepth
+        factor = 255.0 / float(2**targetbitdepth - 1)
+        return [int(round((x >> shift) * factor)) for x in values]
+
+    def _rgb8_over_palette(self, background):
+        """Helper used by :meth:`iterRGB8Over`.  Returns the palette as
+        a list of 3-byte strings, each entry rescaled and composited
+        over `background`.
+        """
+
+        entries = []
+        for p in self.palette(alpha='force'):
+            r,g,b,a = self._rgb8_rescale(p, 8)
+            entries.append(bytes(bytearray(
+              [(x * a + bg * (255 - a)) // 255
+                for x,bg in zip((r,g,b), background)])))
+        return entries
+
+    def _palette_byte_table(self, entries, samples=None):
+        """Helper used by :meth:`iterRGB8Over`.  Returns a 256-entry
+        list, giving for each byte value of a colour type 3 scanline
+        the palette `entries` of the indexes packed into it (of just
+        the first `samples` of them, if given) joined together.  Bytes
+        holding an index beyond the end of the palette map to ``None``.
+        """
+
+        join = strtobytes('').join
+        table = []
+        for indexes in _unpack_table(self.bitdepth):
+            indexes = bytearray(indexes[:samples])
+            if max(indexes) < len(entries):
+                table.append(join([entries[i] for i in indexes]))
+            else:
+                table.append(None)
+        return table
+
+    def _iter_rgb8_over_indexed(self, background, rows):
+        """Helper used by :meth:`iterRGB8Over` for straightlaced colour
+        type 3 images.  Each byte of a scanline is looked up in a table
+        giving the composited RGB of all the pixels packed in it, so
+        indexes are unpacked and mapped through the palette in one go.
+        """
+
+        width = self.width
+        # Pixels per byte, and pixels in the last byte of a row when
+        # they do not fill it.
+        ppb = 8 // self.bitdepth
+        whole,tail = divmod(width, ppb)
+        entries = self._rgb8_over_palette(background)
+        table = self._palette_byte_table(entries)
+        if tail:
+            tailtable = self._palette_byte_table(entries, tail)
+        join = strtobytes('').join
+        raw = self.iterdecomp(self.iteridat())
+
+        def iterbands():
+            band = []
+            for line in self.iterstraight(raw):
+                row = list(map(table.__getitem__, line[:whole]))
+                if tail:
+                    row.append(tailtable[line[whole]])
+                try:
+                    band.append(join(row))
+                except TypeError:
+                    raise FormatError('Palette index out of range.')
+                if len(band) == rows:
+                    yield join(band)
+                    band = []
+            if band:
+                yield join(band)
+        return width,self.height,iterbands(),self._rgb8_over_meta()
+
+    def _iter_rgb8_over_python(self, background, rows):
+        """Helper used by :meth:`iterRGB8Over` when ``numpy`` cannot be
+        imported: each row from :meth:`asRGBA8` is composited in turn.
+        """
+
+        width,height,pixels,meta = self.asRGBA8()
+        def iterbands():
+            band = bytearray()
+            for i,row in enumerate(pixels):
+                out = bytearray(width * 3)
+                alpha = row[3::4]
+                for c in range(3):
+                    bg = background[c]
+                    out[c::3] = bytes([(x * a + bg * (255 - a)) // 255
+                      for x,a in zip(row[c::4], alpha)])
+                band += out
+                if (i + 1) % rows == 0:
+                    yield bytes(band)
+                    band = bytearray()
+            if band:
+                yield bytes(band)
+        return width,height,iterbands(),self._rgb8_over_meta()
+
+    def _rgb8_over_converter(self, background):
+        """Helper used by :meth:`iterRGB8Over` and friends with
+        ``numpy``.  Returns a function that converts a (rows,
+        pixels*planes) ``numpy`` array of sample values to composited
+        8-bit RGB bytes.  A lookup table maps each
+        sample value straight to its 8-bit value (for colour type 3,
+        each palette index to its RGB triple already composited over
+        the background).
+        """
+
+        bitdepth = self.bitdepth
+        planes = self.planes
+        bg = numpy.array(background, dtype=numpy.uint16)
+
+        def over(colour, alpha):
+            """Composite 8-bit `colour` over the background, with
+            8-bit `alpha`."""
+            alpha = alpha[..., numpy.newaxis].astype(numpy.uint16)
+            # colour * alpha + bg * (255 - alpha) is at most 255 * 255.
+            return ((colour * alpha + bg * (255 - alpha)) // 255).astype(
+              numpy.uint8)
+
+        if self.colormap:
+            lut = numpy.frombuffer(
+              strtobytes('').join(self._rgb8_over_palette(background)),
+              dtype=numpy.uint8).reshape(-1, 3)
+        elif bitdepth != 8 or self.sbit:
+            lut = numpy.array(self._rgb8_rescale(range(2**bitdepth),
+              bitdepth), dtype=numpy.uint8)
+        else:
+            lut = None
+        if self.transparent is not None:
+            transparent = numpy.array(self.transparent)
+
+        def convert(values):
+            """Convert a (rows, pixels*planes) array of sample values."""
+            values = values.reshape(len(values), -1, planes)
+            if self.colormap:
+                values = values[..., 0]
+                if values.max() >= len(lut):
+                    raise FormatError('Palette index %d out of range.' %
+                      values.max())
+                return lut[values].tobytes()
+            alpha = None
+            if self.alpha:
+                alpha = values[..., -1]
+                values = values[..., :-1]
+            elif self.transparent is not None:
+                alpha = numpy.where((values != transparent).any(axis=-1),
+                  255, 0)
+            if lut is not None:
+                values = lut[values]
+                if self.alpha:
+                    alpha = lut[alpha]
+            if alpha is not None:
+                # Broadcasting expands greyscale to RGB.
+                return over(values, alpha).tobytes()
+            if self.greyscale:
+                values = numpy.repeat(values, 3, axis=-1)
+            return values.astype(numpy.uint8).tobytes()
+        return convert
+
+    def _iter_rgb8_over_numpy(self, background, rows):
+        """Helper used by :meth:`iterRGB8Over`.  Samples are unpacked
+        into a ``numpy`` array a block of rows at a time, and converted
+        by :meth:`_rgb8_over_converter`.
+        """
+
+        width,height = self.width,self.height
+        planes = self.planes
+        convert = self._rgb8_over_converter(background)
+
+        raw = self.iterdecomp(self.iteridat())
+        if self.interlace:
+            values = self.deinterlace(strtobytes('').join(raw))
+            # The typecode of the array is 'B' or 'H', which numpy reads
+            # as the unsigned types of the same size.
+            values = numpy.frombuffer(values, dtype=values.typecode)
+            values = values.reshape(height, width * planes)
+            def iterbands():
+                for y in range(0, height, rows):
+                    yield convert(values[y:y+rows])
+            return width,height,iterbands(),self._rgb8_over_meta()
+
+        unpack = self._unpack_lines
+        def iterbands():
+            lines = []
+            for line in self.iterstraight(raw):
+                lines.append(line)
+                if len(lines) == rows:
+                    yield convert(unpack(lines))
+                    lines = []
+            if lines:
+                yield convert(unpack(lines))
+        return width,height,iterbands(),self._rgb8_over_meta()
+
+    def _unpack_lines(self, lines):
+        """Helper used by :meth:`iterRGB8Over` and friends with
+        ``numpy``.  Returns the sample values of the unfiltered
+        scanlines `lines` as a (rows, width*planes) array.
+        """
+
+        bitdepth = self.bitdepth
+        dtype = numpy.dtype('>u2' if bitdepth > 8 else 'u1')
+        a = numpy.frombuffer(strtobytes('').join(lines), dtype=dtype)
+        a = a.reshape(len(lines), -1)
+        if bitdepth < 8:
+            # Unpack the samples in each byte, most significant first.
+            shifts = numpy.arange(8 - bitdepth, -1, -bitdepth,
+              dtype=numpy.uint8)
+            a = (a[..., numpy.newaxis] >> shifts) & (2**bitdepth - 1)
+            a = a.reshape(len(lines), -1)[:, :self.width*self.planes]
+        return a
+
 
 # === Legacy Version Support ===
 
@@ -2411,6 +3258,246 @@ class Test(unittest.TestCase):
                          list(map(mask.__and__, list(range(1,256)))))
     def testL8(self):
         return self.helperLN(8)
+    def testLargeIDAT(self):
+        """Rows straddling IDAT chunks and decompressing to more than
+        fits in one call of the decompressor."""
+        w,h = 300,200
+        rows = [[(x*y + y) & 0xff for x in range(w*3)] for y in range(h)]
+        for chunk_limit in (2**20, 1000):
+            o = BytesIO()
+            Writer(w, h, chunk_limit=chunk_limit).write(o, rows)
+            x,y,pixels,meta = Reader(bytes=o.getvalue()).read()
+            self.assertEqual((x,y), (w,h))
+            self.assertEqual(list(map(list, pixels)), rows)
+    def testBuffer(self):
+        """Reading from memoryview and mmap sources, with and without
+        checking CRCs."""
+        import mmap
+        w,h = 40,30
+        rows = [[(x + y*7) & 0xff for x in range(w*3)] for y in range(h)]
+        o = BytesIO()
+        Writer(w, h).write(o, rows)
+        data = bytearray(o.getvalue())
+        # Spoil the CRC of the IDAT chunk.
+        i = data.index(strtobytes('IDAT'))
+        (length,) = struct.unpack('!I', data[i-4:i])
+        data[i+4+length] ^= 0xff
+        r = Reader(bytes=memoryview(data))
+        self.assertRaises(ChunkError, lambda: list(r.read()[2]))
+        m = mmap.mmap(-1, len(data))
+        m.write(data)
+        for source in (memoryview(data), m):
+            x,y,pixels,meta = Reader(bytes=source, check_crc=False).read()
+            self.assertEqual(list(map(list, pixels)), rows)
+    def testRGB8Over(self):
+        """asRGB8Over, with and without numpy, agrees with compositing
+        the rows of asRGBA8."""
+        global numpy
+        bg = (10,200,77)
+        for name in ('basn0g01 basi0g04 basn0g16 basi0g08 basn2c16 '
+          's09n3p02 basi3p08 basn6a08 basn6a16 tbrn2c08 tbbn1g04 '
+          'tbgn3p08 Basn0g03').split():
+            x,y,rows,meta = Reader(bytes=_pngsuite[name]).asRGBA8()
+            expected = bytearray()
+            for row in rows:
+                for i in range(0, len(row), 4):
+                    expected.extend([(row[i+c]*row[i+3] + bg[c]*(255-row[i+3]))
+                      // 255 for c in range(3)])
+            saved = numpy
+            try:
+                for numpy in (saved, None):
+                    r = Reader(bytes=_pngsuite[name]).asRGB8Over(bg)
+                    self.assertEqual(r[:2], (x,y))
+                    self.assertEqual(r[2], expected, name)
+            finally:
+                numpy = saved
+    def testRGB8OverIndexed(self):
+        """asRGB8Over on a 2-bit palette image, with an index beyond
+        the end of the palette in one of them."""
+        palette = [(1,2,3),(4,5,6)]
+        o = BytesIO()
+        Writer(5, 1, bitdepth=2, palette=palette).write(o, [[0,1,1,1,0]])
+        x,y,pixels,meta = Reader(bytes=o.getvalue()).asRGB8Over()
+        self.assertEqual(list(pixels), [1,2,3] + [4,5,6]*3 + [1,2,3])
+        o = BytesIO()
+        Writer(5, 1, bitdepth=2, palette=palette).write(o, [[0,1,3,1,0]])
+        r = Reader(bytes=o.getvalue())
+        self.assertRaises(FormatError, r.asRGB8Over)
+    def testDeinterlacePreview(self):
+        """Previews from iterdeinterlace, with and without numpy."""
+        global numpy
+        w,h = 13,10
+        rows = [[(x*3 + y*29) & 0xff for x in range(w*3)] for y in range(h)]
+        o = BytesIO()
+        Writer(w, h, interlace=True).write(o, rows)
+        saved = numpy
+        try:
+            for numpy in (saved, None):
+                r = Reader(bytes=o.getvalue())
+                r.preamble()
+                raw = r.iterdecomp(r.iteridat())
+                result = list(r.iterdeinterlace(raw))
+                self.assertEqual([p for p,a in result], [1,3,5,7])
+                self.assertEqual(list(result[-1][1]), sum(rows, []))
+                for passes,a in result[:-1]:
+                    step = (0,8,0,4,0,2)[passes]
+                    for y in range(h):
+                        for x in range(w):
+                            y0,x0 = y - y%step, 3*(x - x%step)
+                            self.assertEqual(list(a[(y*w+x)*3:(y*w+x+1)*3]),
+                              rows[y0][x0:x0+3])
+                r = Reader(bytes=o.getvalue())
+                r.preamble()
+                raw = strtobytes('').join(r.iterdecomp(r.iteridat()))
+                self.assertEqual(r.deinterlace(raw, 3), result[1][1])
+            # The previews of iterRGB8OverPreviews are the decoded
+            # pixels only.
+            numpy = saved
+            if numpy is None:
+                return
+            r = Reader(bytes=o.getvalue())
+            result = list(r.iterRGB8OverPreviews())
+            self.assertEqual([m.get('preview') for x,y,p,m in result],
+              [1,3,5,None])
+            for step,(x,y,pixels,meta) in zip((8,4,2,1), result):
+                self.assertEqual((x,y), meta['size'])
+                self.assertEqual((x,y), ((w+step-1)//step, (h+step-1)//step))
+                self.assertEqual(list(pixels),
+                  [v for row in rows[::step]
+                    for i in range(0, w*3, 3*step) for v in row[i:i+3]])
+        finally:
+            numpy = saved
+    def testDeinterlaceSteps(self):
+        """iterdeinterlace with `steps` gives the same image, handing
+        back control within the passes."""
+        global numpy
+        w,h = 37,80
+        rows = [[(x*7 + y*y*3) & 0xff for x in range(w*3)] for y in range(h)]
+        # Interlaced by hand, as Writer writes only filter type 0: the
+        # rows of each pass cycle through the types, mostly average and
+        # paeth, so that numpy undoes them a diagonal at a time.
+        data = bytearray()
+        for xstart,ystart,xstep,ystep in _adam7:
+            prev = None
+            for i,y in enumerate(range(ystart, h, ystep)):
+                line = array('B')
+                for x in range(xstart, w, xstep):
+                    line.extend(rows[y][3*x:3*x+3])
+                data.extend(filter_scanline((0,1,2,3,4,4,3,4)[i % 8], line, 3,
+                  prev))
+                prev = line
+        o = BytesIO()
+        write_chunks(o, [('IHDR', struct.pack('!2I5B', w, h, 8, 2, 0, 0, 1)),
+          ('IDAT', zlib.compress(bytes(data))), ('IEND', strtobytes(''))])
+        saved = numpy
+        try:
+            for numpy in (saved, None):
+                r = Reader(bytes=o.getvalue())
+                r.preamble()
+                raw = r.iterdecomp(r.iteridat())
+                result = list(r.iterdeinterlace(raw, (), steps=16))
+                self.assertEqual(list(result[-1][1]), sum(rows, []))
+                # Passes 4 and 5 have 20 rows, 6 and 7 have 40: every
+                # 16 rows but the last a step, then the finished image.
+                self.assertEqual([p for p,a in result], [4,5,6,6,7,7,7])
+                self.assertEqual([a for p,a in result[:-1]], [None]*6)
+        finally:
+            numpy = saved
+    def testWriteBuffer(self):
+        """write_buffer round trips, with and without numpy, and with
+        several blocks of rows."""
+        global numpy
+        import random
+        random.seed(19)
+        w,h = 23,17
+        saved = numpy
+        try:
+            for numpy in (saved, None):
+                for planes in (1,3,4):
+                    # Smooth, so that filters other than 0 win.
+                    pixels = bytes(bytearray(
+                      [(x*x//50 + y*3 + random.randrange(4)) & 0xff
+                        for y in range(h) for x in range(w*planes)]))
+                    for kw in (dict(), dict(interlace=True),
+                      dict(chunk_limit=100, strategy=zlib.Z_RLE)):
+                        o = BytesIO()
+                        Writer(w, h, greyscale=planes==1, alpha=planes==4,
+                          **kw).write_buffer(o, pixels)
+                        r = Reader(bytes=o.getvalue())
+                        x,y,flat,meta = r.read_flat()
+                        self.assertEqual(bytes(flat), pixels)
+        finally:
+            numpy = saved
+        self.assertRaises(ValueError,
+          Writer(w, h).write_buffer, BytesIO(), pixels)
+    def testRGB8OverSampled(self):
+        """iterRGB8OverSampled picks the same pixels out as asRGB8Over
+        gives, with and without numpy."""
+        global numpy
+        columns = [0,0,3,7,8]
+        rows = [1,2,2,5,8]
+        saved = numpy
+        try:
+            for numpy in (saved, None):
+                for name in 'basn0g04 basi0g08 basn6a16 s09n3p02'.split():
+                    x,y,pixels,meta = Reader(bytes=_pngsuite[name]
+                      ).asRGB8Over()
+                    expected = [bytes(bytearray(sum([list(
+                      pixels[(r*x+c)*3:(r*x+c)*3+3]) for c in columns], [])))
+                      for r in rows]
+                    r = Reader(bytes=_pngsuite[name])
+                    self.assertEqual(list(r.iterRGB8OverSampled(
+                      columns=columns, rows=rows)), expected)
+        finally:
+            numpy = saved
+    def testUndoFilterFast(self):
+        """undo_filter_fast gives the same bytes as undo_filter."""
+        import random
+        random.seed(14)
+        r = Reader(bytes=strtobytes(''))
+        for fu in (1,2,3,4,6,8):
+            r.psize = fu
+            n = fu*37
+            previous = bytes(random.randrange(256) for _ in range(n))
+            scanline = bytes(random.randrange(256) for _ in range(n))
+            for filter_type in range(5):
+                for prev in (previous, None):
+                    self.assertEqual(
+                      r.undo_filter_fast(filter_type, scanline, prev),
+                      r.undo_filter(filter_type, scanline, prev))
+        self.assertRaises(FormatError, r.undo_filter_fast, 5, scanline, None)
+    def testUndoFilterRows(self):
+        """undo_filter_rows gives the same rows as undo_filter, with and
+        without numpy, whichever way it undoes them."""
+        global numpy
+        import random
+        random.seed(20)
+        r = Reader(bytes=strtobytes(''))
+        saved = numpy
+        try:
+            for numpy in (saved, None):
+                for fu,units,rows,types in ((1,50,20,(4,)), (3,30,40,(3,4)),
+                  (6,9,17,(0,1,2,3,4)), (3,25,30,(0,1,2,3,4,4,4,4,4,3)),
+                  (4,7,5,(4,)), (2,3,64,(4,))):
+                    r.psize = fu
+                    rb = fu*units
+                    data = bytearray()
+                    for y in range(rows):
+                        data.append(random.choice(types))
+                        data.extend(random.randrange(256) for _ in range(rb))
+                    for previous in (None,
+                      bytes(random.randrange(256) for _ in range(rb))):
+                        expected = []
+                        recon = previous
+                        for i in range(0, len(data), rb+1):
+                            recon = r.undo_filter(data[i],
+                              data[i+1:i+1+rb], recon)
+                            expected.append(recon)
+                        self.assertEqual(
+                          r.undo_filter_rows(memoryview(data), rb, previous),
+                          expected)
+        finally:
+            numpy = saved
     def testL4(self):
         return self.helperLN(4)
     def testL2(self):
@@ -2703,10 +3790,10 @@ class Test(unittest.TestCase):
         self.assertEqual(_enhex(d), '255cd971ab8cd9e7275ff906e5041aa0')
     def testfromarray(self):
         img = from_array([[0, 0x33, 0x66], [0xff, 0xcc, 0x99]], 'L')
-        img.save('testfromarray.png')
+        img.save(BytesIO())
     def testfromarrayL16(self):
         img = from_array(group(list(range(2**16)), 256), 'L;16')
-        img.save('testL16.png')
+        img.save(BytesIO())
     def testfromarrayRGB(self):
         img = from_array([[0,0,0, 0,0,1, 0,1,0, 0,1,1],
                           [1,0,0, 1,0,1, 1,1,0, 1,1,1]], 'RGB;1')
@@ -2718,9 +3805,7 @@ class Test(unittest.TestCase):
         i = itertools.islice(itertools.count(10), 20)
         i = map(lambda x: [x, x, x], i)
         img = from_array(i, 'RGB;5', dict(height=20))
-        f = open('testiter.png', 'wb')
-        img.save(f)
-        f.close()
+        img.save(BytesIO())
 
     # numpy dependent tests.  These are skipped (with a message to
     # sys.stderr) if numpy cannot be imported.
@@ -2770,7 +3855,7 @@ class Test(unittest.TestCase):
 
         pixels = numpy.array([[0,0x5555],[0x5555,0xaaaa]], numpy.uint16)
         img = from_array(pixels, 'L')
-        img.save('testnumpyL16.png')
+        img.save(BytesIO())
 
 # === Command Line Support ===
 
@@ -0,0 +1,244 @@
+"""tests for the banner decoders and the banner rotation.  run with python -m unittest test_banners,
+or python -m pytest test_banners.py, from this directory"""
+
+import base64
+import heapq
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+
+import nanojpeg_13b as nanojpeg
+import tournament_clock
+
+EXAMPLE_BANNERS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples', 'banners')
+
+# 61 x 45 baseline greyscale JPEG, quality 85, a downsized dog_001.jpg
+GREY_JPEG = base64.b64decode('''
+/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAAUDBAQEAwUEBAQFBQUGBwwIBwcHBw8LCwkMEQ8SEhEPERETFhwXExQaFRERGCEYGh0d
+Hx8fExciJCIeJBweHx7/wAALCAAtAD0BAREA/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUF
+BAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVW
+V1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi
+4+Tl5ufo6erx8vP09fb3+Pn6/9oACAEBAAA/APCltrlEFxk7D3Iz/Sm/OuAVT5ueUFSbCQhIVQe6jFdP4C1/SvDWptfX2hJq0hwI
+WN0Ymh9SvykZ9yOO1dtffFPwzc2EltP4Iu5UkUqyS6qrIwPqDFXkGoxQSXs9xbWktraszNFE0hfYv93cQM49cVWW3V+VV29t3Slk
+syIkkCsoYkdSemK1VgeWGILhdwxwwJOAe3Wg2Qcjk/5ANa+kWsNv5M0tulwqsWMTkgMORgkcitmNdAYRqnhaIsjBlzqEvY5546VH
+JoTrD5nk28m1RI6xSBygYnGQOR06dcVevdMuItE021sIInvdSnKxbU8xyyhSFxz13jjHO2ktRosb3iaj4fvb6aK4aN5obgKOx7g9
+Mmsb7Tpmr6ZbrY6LJH5EkgkbzQ24kjGOnGAPzNUpHm0/ybOCDy/NVGMrKpeTPdWPQdsD05ra0bQJvEN+bGwns4r1bM3ASRsC5ZM7
+1Ujo+BkDvg96v6rpVjY+Flv/ADLyO6EpUeZHmCQBcttbAOQxAPUc1z9ndXF89tpdi7tJNhSsS8s2Od+eo698YqfVbPWUvb3Onz2g
+iLWssyxMoWQDJBYjlh1/LtivsHw3Z+DrLwHpfji6tLOCa30COE3oQFkTywCFx/ETxnqelfJN7qtldWskkdxKkDBn2lAvfjOOhPOf
+wrm/DjX628z2csfltKRhzwMelaEaJrfh7T0csz2vy7YyAdp4xz7hT+NdVe+E7LSF03VdJ1s3MMytAUIME1o4HDODnIOT0PPODXQ6
+P4X1XxRp8K3ur6XZ6ZYIIkWV2M0qBi2FRc7QxOevOe1Zlv4fs9DuLm6TUI0jtp0jEkdqfmLJkgITuAwfXHH0rpk1B9Yt5ootQzbC
+HJDWMhTggNn5iWY8Z74HXip50S3+Gz+GLaCWeffxIbtxb+XuyR5JB525HJ9+teYTeHtNttAxdPbwyXRKwpNKRIhHQlf4cnpnnFY3
+hOylhhuYGUtLHLh9jcdO1Zvg+cxyXFrtYsQwUqf4uqn81/WvVPh1qh1K8i02aaJ4L1PKlWV1UMvXhjgBhjIPY4965K68dXthMdOj
+t7az+yyNE4+zrufax5cg8t7/AJVa8O+PZdMhaOdoLiJ2BG/zEI65JYDJ69DxwK3rD4nCz3f2klp9oAJjEcEiKqtyPl7nH8XXn0qK
+b4v2scnz6ZBcoZAzRqJFDr3U9DycHPbHua534nfEW18W2sFppHhWHTNqhWmeYySPgHgDhQOepyfeud026uLHTY5JJU86V2DbWDcK
+ABn8zWbpUiwajFJErhiMH5+479PbNStqFxbX9wYG8tTKxCgcDmtXR9avBdxSultLtYNiSBWzg9+Oa9r8dt4Tu/hTJ4isvBWmaVq0
+kQkjubM+WYnzjcABj8Pevne7MqJHIZS7SDcSQM/nToFQMBKDISOMnAB+g6/jWhfXzeVmWw0p/lxkWYjb80IrEuGK7Yl+VF5ABOAT
+ya//2Q==''')
+
+# 67 x 45 baseline colour JPEG, 4:2:0, quality 85, a restart marker every 2 MCUs, a downsized dog_002.jpg
+DRI_JPEG = base64.b64decode('''
+/9j/4AAQSkZJRgABAQAAAQABAAD//gAmRmlsZSB3cml0dGVuIGJ5IEFkb2JlIFBob3Rvc2hvcKggNS4w/9sAQwAFAwQEBAMFBAQE
+BQUFBgcMCAcHBwcPCwsJDBEPEhIRDxERExYcFxMUGhURERghGBodHR8fHxMXIiQiHiQcHh8e/9sAQwEFBQUHBgcOCAgOHhQRFB4e
+Hh4eHh4eHh4eHh4eHh4eHh4eHh4eHh4eHh4eHh4eHh4eHh4eHh4eHh4eHh4eHh4e/8AAEQgALQBDAwEiAAIRAQMRAf/EAB8AAAEF
+AQEBAQEBAAAAAAAAAAABAgMEBQYHCAkKC//EALUQAAIBAwMCBAMFBQQEAAABfQECAwAEEQUSITFBBhNRYQcicRQygZGhCCNCscEV
+UtHwJDNicoIJChYXGBkaJSYnKCkqNDU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6g4SFhoeIiYqSk5SVlpeY
+mZqio6Slpqeoqaqys7S1tre4ubrCw8TFxsfIycrS09TV1tfY2drh4uPk5ebn6Onq8fLz9PX29/j5+v/EAB8BAAMBAQEBAQEBAQEA
+AAAAAAABAgMEBQYHCAkKC//EALURAAIBAgQEAwQHBQQEAAECdwABAgMRBAUhMQYSQVEHYXETIjKBCBRCkaGxwQkjM1LwFWJy0QoW
+JDThJfEXGBkaJicoKSo1Njc4OTpDREVGR0hJSlNUVVZXWFlaY2RlZmdoaWpzdHV2d3h5eoKDhIWGh4iJipKTlJWWl5iZmqKjpKWm
+p6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uLj5OXm5+jp6vLz9PX29/j5+v/dAAQAAv/aAAwDAQACEQMRAD8A+bNM0m2l
+0eCdrddzRDJPc4FZ8mnguR9mKjPYda7nQbRf7A05dnDwxnn1Kg1XjtPOuo4/ILlmxtBJ3e3FKgnONx1EotWOQh0WWbJjs5ZMEZ2p
+nH1rpvDHgI6mnm3bLZReZsw6fOeM8A8V1tnociWzrLDNETOiyL91jweDnpXeeEpbXRysVrJf2zbtv+jzqpl9Oqn2rkxDqTjJU5qN
+nva//AOrB1cPSrxeIpua7Xtd/dc//9DyzV/hpo0ljGlvc+Q0KnD8Nu7/ADDjNea+JfDsmjak9i3lzsoDB4wcEHp9K+n/ABJrPiKC
+OUWes61bN8rKksinau7HHH1rzLUNMe/v2vL6VpZ5G2vJKcliemT+grgyalOalL2ylBafPR3v8z3c6xuCrxUaOFdKfq9tVa1l5anJ
+/CPSPD02tXQ8Sx2S2y2u6MXPC+Zu/wAKq61omkz/ABA1e00qGB7BSDbiLlQpA6e2c1o+JLKPT9ShhV12sCwdG4I7dKTQ7aaz8U+d
+NayJbS2wVZGUhGY54z61PNbFyjfRnnulfDRktz//0fmz7LHaE20kKhkJB496Kt60AuqTqMcN3+goquW2hSasavgW/ubtNJsbqaKG
+3mCQo8rBEBwFyxPGFHzfQ55rpLXwpr2s6ktvpNrKJrWI3MxV/KXy2GEbcQR8xyASMEkcjitT4F/ETTtK+H954dvvDVlfancwpbad
+dtECVLMMeZnsuSwbqOQOtelprEngj4qXd5Hc2M0esaRCumNIQkQtjId0XYAKQV/EeoryK2IlTpTg9vv6ndRjGUoy6r/I/9LlNU1r
+wjbazcWCa9DcXRaCFo7oEGSVFCFgSNqEkscE5HQ1oXei3mp69H4d0xhaSgfaHuWhztjVS/y4wWJ2sAAeo7VxKeBtJ1LU7FrmBZPt
+dtfyziOZseYrnaeDxtzxjjAGa3/Ao1a+fQmt9VW0lvo4kllZ2Gw7dpc8kEnHTA5NfH4jFUYU+WCV+707/wCT+5HsUr1Krk76a7P9
+den69jsPHPhNtKsdK8UpqqxRXUq2a2DSNIzKFUNJubkNnaSnH3iwrjr21v7q0uzp2n6tdyQTnYLTIVlwMl8jPDHBwOK7XVW1jVtS
+m0XU9Yj1ue3mV2BYuElC4XOej7eAOuOO1UvEja7Y2yjV9I1qY3kLyxG3D75UUDOVU4ZQWU+o5PQV1ZXiuRPCqOl73+St9+/TSx5l
+fM4YjEOm4SUknry+7339D//T8W1OK1nnmg1i8fdE5it7rZjarDKjav3ucjAHQdR1ro7oS3Xw5tV8PsLt7ff/AGoJVETbk2tHtJOQ
+CCwHBZmyAMcjn9U0+wkvdSTV0fTZLe0WTTkedt3mtuIU8EbiFAIPYH3rtNG8Sp4b+H2s+d4ZtLODU4rVVuXgIaMrAvzK3OGkUBiM
+5O7NfN4pKLbab169+lv60Z7eDqOcUk7fhp1ueRzbZnEquxDorfMMH7o4oqoZmkJfkbuaK9+m58qPKm48zP/U+bNLllg0e0mgmiR0
+iGF8zax9604tRvNXvA2p6lIyx2zRxRSs0isMZKgLnGcdT7VzcMudLtFI58oDOe2a2Ph7qTaf4u0+5SCOTZKRtbocqRXm8rV/mdMk
+pNWNzw/Y6haww39nLYuvEX7y4KlwDtXgdOnXofeus0h5/wDhG7JrS8NveWzrIBFje23+FN3GfTNedxa7fWV5P9kfyoZC5EBw0aEs
+TkKeKz28Q6kqGBJEROnyoMn8eteVicuqYmV9F/XU9OljaVGNmm9P6sf/1fI2nma4W2Np8QZJ5YjcFEkG9kU4LkKc4B7nnml8CeLd
+dh8Tf2d4Rm8VKlw//ExhubncuzoztuOFIHckZHHNee2uu6xpWvJqWmald2V2rAiWGVlbsfxGexqzqXjbxbeSF7rxDqEhJBP7wDJ9
+Tgc/jXk4bBKlZ319Xb7jpr1nO6W34noHj+/SLxRrLPHbNYxQ224FsyFwG27PXqc1yfinxve65ob6Te3l39naRJFUBScJGqID0GAq
+AevArmG1S/ll8yW5kd5Bh2LHJweOagupupC/N0JJzWssNCU1KS1X+YUq86cHFdf8j//W+boV86MSDndk5Yc/jRVjQvn0mBmHJB/m
+aKyi7JItrmdz/9k=''')
+
+def _grey_420(data):
+  "data, a greyscale JPEG, with its component's sampling factors set to 2x2, which a one component frame ignores"
+  sof = data.index(b'\xff\xc0')
+  return data[:sof + 11] + b'\x22' + data[sof + 12:]
+
+class FakeDisplay( object ) :
+  "stands in for DisplayMan: timers run on a virtual clock, from run_until, and shown banners are recorded"
+  def __init__(self, size=(160, 96)):
+    self.now = 0
+    self.shown = [] # (ms, image)
+    self._size = size
+    self._timers = [] # heap of (due, id, callback, args)
+    self._cancelled = set()
+    self._next_id = 0
+
+  def start_timer(self, ms, callback, *args):
+    self._next_id += 1
+    heapq.heappush(self._timers, (self.now + int(ms), self._next_id, callback, args))
+    return self._next_id
+
+  def cancel_timer(self, id):
+    self._cancelled.add(id)
+
+  def pending(self):
+    return len([t for t in self._timers if t[1] not in self._cancelled])
+
+  def run_until(self, ms):
+    while self._timers and self._timers[0][0] <= ms :
+      due, id, callback, args = heapq.heappop(self._timers)
+      if id in self._cancelled :
+        continue
+      self.now = due
+      callback(*args)
+    self.now = ms
+
+  def apply_banner(self, im):
+    self.shown.append((self.now, im))
+
+  def show_status(self, text):
+    pass
+
+  def get_ideal_banner_size(self):
+    return self._size
+
+class NanoJPEGTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    nanojpeg.njShareTracker()
+    cls.pool = multiprocessing.Pool(2)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.pool.terminate()
+    cls.pool.join()
+
+  def _decode(self, data, use_numpy, scale=1, pool=None):
+    "returns (width, height, pixels) of data decoded at scale, with or without the NumPy path"
+    saved = nanojpeg.NJ_USE_NUMPY
+    nanojpeg.NJ_USE_NUMPY = use_numpy
+    try :
+      nj = nanojpeg.NJ()
+      nanojpeg.njInit(nj)
+      buf = array('B', data)
+      self.assertEqual(nanojpeg.njDecode(nj, buf, len(buf), scale=scale, pool=pool), nanojpeg.NJ_OK)
+      return (nanojpeg.njGetWidth(nj), nanojpeg.njGetHeight(nj), bytes(nanojpeg.njGetImage(nj)))
+    finally :
+      nanojpeg.NJ_USE_NUMPY = saved
+
+  def _samples(self):
+    "(name, JPEG data) for the example banners, the restart interval JPEG and a 4:2:0 greyscale JPEG"
+    ret = []
+    for name in sorted(os.listdir(EXAMPLE_BANNERS)) :
+      with open(os.path.join(EXAMPLE_BANNERS, name), 'rb') as f :
+        ret.append((name, f.read()))
+    return ret + [('dri', DRI_JPEG), ('grey 4:2:0', _grey_420(GREY_JPEG))]
+
+  def testDecodePaths(self):
+    "the pure Python and NumPy paths, at every scale and with or without the pool, give the same pixels"
+    for name, data in self._samples() :
+      for scale in (1, 2, 4, 8) :
+        width, height, pixels = self._decode(data, 0, scale)
+        nj = nanojpeg.NJ()
+        nanojpeg.njInit(nj)
+        nanojpeg.njProbe(nj, data, len(data))
+        self.assertEqual((width, height), ((nanojpeg.njGetWidth(nj) + scale - 1) // scale, (nanojpeg.njGetHeight(nj) + scale - 1) // scale), name)
+        self.assertEqual(len(pixels), width * height * (3 if nanojpeg.njIsColor(nj) else 1), name)
+        self.assertEqual(self._decode(data, 1, scale), (width, height, pixels), (name, scale))
+        self.assertEqual(self._decode(data, 1, scale, self.pool), (width, height, pixels), (name, scale))
+        if name == 'dri' : # the others have no restart intervals, the pool leaves them to the pure path again
+          self.assertEqual(self._decode(data, 0, scale, self.pool), (width, height, pixels), (name, scale))
+
+  def testRestartIntervals(self):
+    "the restart interval sample has enough intervals to be split over the pool"
+    nj = nanojpeg.NJ()
+    nanojpeg.njInit(nj)
+    buf = array('B', DRI_JPEG)
+    nanojpeg.njDecode(nj, buf, len(buf), pool=self.pool)
+    self.assertEqual(nj.rstinterval, 2)
+    self.assertTrue(len(nj.segs) > 1)
+
+  def testPickScale(self):
+    "the smallest decode that still covers the target in the dimension that limits the fit"
+    self.assertEqual(nanojpeg.njPickScale(1184, 816, 800, 480), 1)
+    self.assertEqual(nanojpeg.njPickScale(6400, 3840, 800, 480), 8)
+    self.assertEqual(nanojpeg.njPickScale(4000, 1000, 800, 480), 4) # wide: the width limits the fit
+    self.assertEqual(nanojpeg.njPickScale(1000, 4000, 800, 480), 8) # tall: the height does
+    self.assertEqual(nanojpeg.njPickScale(4000, 3000, 800, 480), 4)
+    self.assertEqual(nanojpeg.njPickScale(3000, 4000, 800, 480), 8)
+    self.assertEqual(nanojpeg.njPickScale(640, 400, 800, 480), 1)
+
+class ReadBannerTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._tmp)
+
+  def _write(self, name, data):
+    filename = os.path.join(self._tmp, name)
+    with open(filename, 'wb') as f :
+      f.write(data)
+    return filename
+
+  def testGreyJPEG(self):
+    "a greyscale JPEG comes out as RGB rows, each pixel its grey value three times"
+    filename = self._write('grey.jpg', GREY_JPEG)
+    info = tournament_clock.probe(filename)
+    self.assertEqual((info['width'], info['height'], info['mode']), (61, 45, 'L'))
+    width, height, rows = tournament_clock._read_JPG(filename)
+    self.assertEqual((width, height, len(rows)), (61, 45, 45))
+    grey = b''.join(rows[y][0::3] for y in range(height))
+    for y in range(height) :
+      self.assertEqual(len(rows[y]), width * 3)
+      self.assertEqual(rows[y][0::3], rows[y][1::3])
+      self.assertEqual(rows[y][0::3], rows[y][2::3])
+    self.assertTrue(len(set(grey)) > 16) # the picture, not a blank
+    width, height, pixels, name = tournament_clock._read_banner(filename, 'JPEG', (40, 40))
+    self.assertEqual((width, height, len(pixels)), (40, 29, 40 * 29 * 3))
+
+class BannerControllerTest(unittest.TestCase):
+  def setUp(self):
+    self._saved = (tournament_clock.BANNER_CACHE_PATH, tournament_clock._convert_to_photoimage, tournament_clock.multiprocessing.cpu_count)
+    self._tmp = tempfile.mkdtemp()
+    tournament_clock.BANNER_CACHE_PATH = os.path.join(self._tmp, 'cache')
+    tournament_clock._convert_to_photoimage = lambda img : img[:2] # no Tk root here
+    tournament_clock.multiprocessing.cpu_count = lambda : 1 # decoded in slices from the (fake) event loop
+
+  def tearDown(self):
+    tournament_clock.BANNER_CACHE_PATH, tournament_clock._convert_to_photoimage, tournament_clock.multiprocessing.cpu_count = self._saved
+    shutil.rmtree(self._tmp)
+
+  def testHoldWhileWaiting(self):
+    "a banner finishing after a hold and unhold, while the rotation waits for it, does not start a second rotation"
+    display = FakeDisplay()
+    controller = tournament_clock.BannerController(10, EXAMPLE_BANNERS, display)
+    self.assertTrue(controller._waiting) # nothing decoded yet
+    controller.hold()
+    controller.unhold()
+    display.run_until(60000)
+    times = [ms for ms, im in display.shown]
+    self.assertTrue(len(times) >= 5)
+    for a, b in zip(times, times[1:]) :
+      self.assertTrue(b - a >= 10000, times)
+    controller.hold()
+    display.run_until(120000)
+    self.assertEqual(len(display.shown), len(times)) # the hold stopped the only rotation there was
+    controller.shutdown()
+
+if __name__ == '__main__' :
+  unittest.main()
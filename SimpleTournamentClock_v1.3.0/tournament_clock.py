@@ -64,11 +64,18 @@ from xml.sax.handler import ContentHandler
 
 import glob
 import random
+import hashlib
+import struct
 
 import nanojpeg_13b as nanojpeg # JPEG image file support
 import png # PNG image file support
 import array
+import mmap
 import multiprocessing
+try:
+  from multiprocessing import shared_memory # python 3.8 and later
+except ImportError:
+  shared_memory = None
 
 #===============================================================================================
 # free ringtones, need to be converted from mp4 to wav:
@@ -99,6 +106,13 @@ SOUND_LEVELCHANGE = "newlevel.wav"
 SOUND_TIMEBARRIER = 10
 
 TITLE = "Tournament Clock"
+STATUS_SECONDS = 15 # how long a message stays under the banner
+
+BANNER_MAX_PIXELS = 40000000 # larger JPEG and interlaced PNG banners are rejected before they are decoded
+PROBE_BYTES = 65536 # the headers of most files fit in the first read
+BANNER_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".tournament_clock", "banners") # resized banners, kept between launches
+BANNER_CACHE_BYTES = 256 * 1024 * 1024 # the least recently used banners are evicted past this
+BANNER_LOOKAHEAD = 2 # banners decoded ahead of the one on display
 
 #===============================================================================================
 def safe_int(i):
@@ -519,6 +533,8 @@ class DisplayMan(object):
     self._str_avestack = tkinter.StringVar()
     self._str_totalstack = tkinter.StringVar()
     self._str_paid = tkinter.StringVar()
+    self._str_status = tkinter.StringVar()
+    self._status_timer = None
     
     self.root.frame_full = tkinter.Frame(self.root)
     self.root.frame_full.configure(width=width, height=height)
@@ -655,6 +671,9 @@ class DisplayMan(object):
     self.label_banner = tkinter.Label(self.bottom_frame, fg='black', bg='white', borderwidth=0)
     self.label_banner.grid(row=0,sticky=tkinter.N+tkinter.S+tkinter.E+tkinter.W)
     
+    self.label_status = tkinter.Label(self.bottom_frame, textvariable=self._str_status, font=self.font_1, fg='gray', bg='white')
+    self.label_status.grid(row=1,sticky=tkinter.N+tkinter.S+tkinter.E+tkinter.W)
+    
     self._last_resize = datetime.datetime.now()
     self.root.frame_full.bind("<Configure>", self.resize_fonts)
     self.root.withdraw()
@@ -726,6 +745,17 @@ class DisplayMan(object):
     self.label_banner.configure(image=im, fg='black', bg='white', anchor=tkinter.CENTER)
     return
     
+  def show_status(self, text):
+    "shows text under the banner for STATUS_SECONDS, without interrupting anything"
+    self._str_status.set(text)
+    if self._status_timer :
+      self.cancel_timer(self._status_timer)
+    self._status_timer = self.start_timer(STATUS_SECONDS * 1000, self._clear_status)
+    
+  def _clear_status(self):
+    self._status_timer = None
+    self._str_status.set('')
+    
   def get_ideal_banner_size(self):
     width = self.root.winfo_screenwidth()
     height = self.root.winfo_screenheight()
@@ -937,7 +967,9 @@ class ClockController( object ):
     return
 
 #===============================================================================================
-def _img_resize(Source, TgtWidth, TgtHeight):
+def _resize_indices(Source_width, Source_height, TgtWidth, TgtHeight):
+  """the nearest neighbour sampling of _img_resize: returns (target_width, target_height, xlist, ylist),
+  where xlist and ylist hold the source column and row of each target column and row"""
   def get_incrlist(inwidth, outwidth, oversize=False):
     izoom = int(10000.0 * float(inwidth) / float(outwidth))
     delta = 0
@@ -952,18 +984,11 @@ def _img_resize(Source, TgtWidth, TgtHeight):
       ret[x] = jump
     return ret
   
-  Source_width = Source[0]
-  Source_height = Source[1]
-  img_list = Source[2]
-
-  for y in range(Source_height) : # box pixels, box rows
-    img_list[y] = [tuple(img_list[y][x:x+3]) for x in range(0,Source_width*3,3)]
-    
   relative_width = float(Source_width) / float(TgtWidth)
   relative_height = float(Source_height) / float(TgtHeight)
   rel = max(relative_width, relative_height)
   if rel == 0 :
-    return Source
+    return None
   target_width = int(Source_width / rel)
   target_height = int(Source_height / rel)
   
@@ -978,88 +1003,383 @@ def _img_resize(Source, TgtWidth, TgtHeight):
     i += xincrlist[x]
     
   j = 0
-  output_img = []
+  ylist = []
   for y in range(target_height) :
-    output_img.append([img_list[j][xlist[x]] for x in range(target_width)])
+    ylist.append(j)
     j += yincrlist[y]
 
+  return (target_width, target_height, xlist, ylist)
+
+def _img_resize(Source, TgtWidth, TgtHeight):
+  return _run_steps(_img_resize_steps(Source, TgtWidth, TgtHeight))
+
+def _img_resize_steps(Source, TgtWidth, TgtHeight, rows=16):
+  """generator form of _img_resize, sampling rows target rows per step.  the rows of Source are flat pixels,
+  only the pixels that are used are boxed"""
+  indices = _resize_indices(Source[0], Source[1], TgtWidth, TgtHeight)
+  if indices is None :
+    return Source
+  target_width, target_height, xlist, ylist = indices
+  img_list = Source[2]
+  join = b''.join
+  output_img = []
+  for y in ylist :
+    row = img_list[y]
+    row = join([row[3*x:3*x+3] for x in xlist])
+    output_img.append(list(zip(row[0::3], row[1::3], row[2::3])))
+    if not len(output_img) % rows :
+      yield
   return (target_width, target_height, output_img)
 
-def _read_JPG(filename) :
+def probe(filename) :
+  """reads only the headers of a JPEG or PNG file.  returns None if it is neither, or a dict with
+  format, width, height, mode ('L', 'LA', 'P', 'PA', 'RGB' or 'RGBA'), bitdepth,
+  progressive (a progressive JPEG or an interlaced PNG), orientation (EXIF, 1 is upright)
+  and thumbnail (the JPEG data of the EXIF thumbnail, or None)"""
+  with open(filename, 'rb') as f :
+    head = f.read(PROBE_BYTES)
+    if head[:2] == b'\xff\xd8' :
+      nj = nanojpeg.NJ()
+      nanojpeg.njInit(nj)
+      try :
+        result = nanojpeg.njProbe(nj, head, len(head))
+      except Exception :
+        result = nanojpeg.NJ_SYNTAX_ERROR
+      if result != nanojpeg.NJ_OK and len(head) == PROBE_BYTES : # headers run past the first read
+        head += f.read()
+        try :
+          result = nanojpeg.njProbe(nj, head, len(head))
+        except Exception :
+          pass
+      if result != nanojpeg.NJ_OK :
+        return None
+      return { 'format' : 'JPEG',
+               'width' : nanojpeg.njGetWidth(nj),
+               'height' : nanojpeg.njGetHeight(nj),
+               'mode' : 'RGB' if nanojpeg.njIsColor(nj) else 'L',
+               'bitdepth' : 8,
+               'progressive' : bool(nanojpeg.njIsProgressive(nj)),
+               'orientation' : nanojpeg.njGetOrientation(nj),
+               'thumbnail' : nanojpeg.njGetThumbnail(nj) }
+    if head[:8] == b'\x89PNG\r\n\x1a\n' :
+      f.seek(0)
+      reader = png.Reader(file = f)
+      try :
+        reader.preamble() # IHDR, PLTE, tRNS and the like, up to the first IDAT
+      except Exception :
+        return None
+      mode = 'P' if reader.colormap else ('L' if reader.greyscale else 'RGB')
+      if reader.alpha or reader.trns :
+        mode += 'A'
+      return { 'format' : 'PNG',
+               'width' : reader.width,
+               'height' : reader.height,
+               'mode' : mode,
+               'bitdepth' : reader.bitdepth,
+               'progressive' : bool(reader.interlace),
+               'orientation' : 1,
+               'thumbnail' : None }
+  return None
+
+def _run_steps(steps) :
+  "runs a generator from one of the _read_*_steps functions to the end, returns its result"
+  while True :
+    try :
+      next(steps)
+    except StopIteration as e :
+      return e.value
+
+def _decode_JPG_steps(buf, target_size=None) :
+  "generator decoding JPEG data a few MCU rows per step, returns (width, height, rows)"
+  nj = nanojpeg.NJ()
+  nanojpeg.njInit(nj)
+  yield from nanojpeg.njDecodeSteps(nj, buf, len(buf), target=target_size)
+  width = nanojpeg.njGetWidth(nj)
+  height = nanojpeg.njGetHeight(nj)
+  pixels = nanojpeg.njGetImage(nj)
+  if nanojpeg.njIsColor(nj) :
+    row_pixels = [bytes(pixels[y:y+width*3]) for y in range(0,width*height*3,width*3)] # box rows flat pixels; bytes, as memoryviews do not pickle
+  else : # one grey byte a pixel, spread over R, G and B like the colour rows
+    row_pixels = []
+    for y in range(0,width*height,width) :
+      row = bytearray(width*3)
+      row[0::3] = row[1::3] = row[2::3] = pixels[y:y+width]
+      row_pixels.append(bytes(row))
+  return (width, height, row_pixels)
+
+def _read_JPG_steps(filename, target_size=None) :
+  "generator form of _read_JPG, decoding a few MCU rows per step"
   try :
-    nj = nanojpeg.NJ()
-    nanojpeg.njInit(nj)
     buf = open(filename, 'rb').read()
     buf = array.array('B', buf)
-    nanojpeg.njDecode(nj, buf, len(buf))
-    width = nanojpeg.njGetWidth(nj)
-    height = nanojpeg.njGetHeight(nj)
-    pixels = nanojpeg.njGetImage(nj)
-    row_pixels = [pixels[y:y+width*3] for y in range(0,width*height*3,width*3)] # box rows flat pixels
-    return (width, height, row_pixels)
-  except:
+    img = yield from _decode_JPG_steps(buf, target_size)
+    if target_size is not None :
+      img = _img_resize(img, target_size[0], target_size[1])
+    return img
+  except Exception :
     return(0,0,None,filename)
-  
 
-def _read_PNG(filename) :
+def _read_JPG(filename, target_size=None) :
+  """with target_size the image comes out resized to fit it (boxed pixels, ready for _convert_to_photoimage),
+  and the decoder skips detail that resizing would throw away"""
+  return _run_steps(_read_JPG_steps(filename, target_size))
+
+def _read_PNG_steps(filename, previews=False, target_size=None) :
+  """generator form of _read_PNG, reading 16 rows (of a pass, when interlaced) or resizing 16 target rows per step,
+  or one target row per step when streaming.  with previews, an interlaced PNG also yields the (width, height, rows)
+  decoded so far after passes 1, 3 and 5, at 1/8, 1/4 and 1/2 size.  only the single core loader asks for
+  previews, a pool task returns just the final image"""
+  try :
+    with open(filename, 'rb') as f : # map the file, the reader walks its chunks in place
+      buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  except Exception :
+    return(0,0,None,filename)
+  try :
+    return (yield from _decode_PNG_steps(buf, filename, previews, target_size))
+  finally : # unmapped now, not whenever it is collected: a mapped banner stays locked on Windows
+    try :
+      buf.close()
+    except BufferError : # should anything still hold a view of it, it is unmapped once that goes
+      pass
+
+def _decode_PNG_steps(buf, filename, previews, target_size) :
+  "_read_PNG_steps, once the file is mapped"
   try :
-    fp = png.Reader(filename = filename)
-    width, height, pixels, metadata = fp.asRGBA() # don't raise an exception with alpha, just filter it out
-    if height > 0 and pixels is not None :
-      no_alpha_indices = list(range(width*4))
-      del no_alpha_indices[3::4]
-      pixels = [[(row[x] * row[x | 0x03] + (255 - row[x | 0x03]) * 255)//255 for x in no_alpha_indices ] for row in pixels] # comp over white
+    fp = png.Reader(bytes = buf, check_crc = False) # local banner files are trusted
+    fp.preamble()
+    indices = None
+    if target_size is not None and not fp.interlace :
+      indices = _resize_indices(fp.width, fp.height, target_size[0], target_size[1])
+    if indices is not None : # streamed straight to the target size, only a band of source rows is held at a time
+      width, height, xlist, ylist = indices
+      pixels = []
+      for row in fp.iterRGB8OverSampled((255, 255, 255), xlist, ylist) :
+        pixels.append(list(zip(row[0::3], row[1::3], row[2::3]))) # box pixels, like _img_resize
+        yield
+      return (width, height, pixels, filename)
+    if fp.interlace : # decoded a pass at a time, 16 rows of a pass per step
+      for img in fp.iterRGB8OverPreviews((255, 255, 255), (1, 3, 5) if previews else (), 16) :
+        if img is None :
+          yield
+          continue
+        width, height, pixels, metadata = img
+        if 'preview' in metadata :
+          yield (width, height, [pixels[y:y+width*3] for y in range(0, len(pixels), width*3)])
+      pixels = [bytes(pixels[y:y+width*3]) for y in range(0, len(pixels), width*3)]
+      yield
+    else :
+      width, height, bands, metadata = fp.iterRGB8Over((255, 255, 255), 16) # don't raise an exception with alpha, comp over white
+      pixels = []
+      for band in bands :
+        pixels.extend(band[y:y+width*3] for y in range(0, len(band), width*3)) # box rows flat pixels
+        yield
+    if target_size is not None :
+      width, height, pixels = yield from _img_resize_steps((width, height, pixels), target_size[0], target_size[1])
       
     return (width, height, pixels, filename)
-  except:
+  except Exception :
     return(0,0,None,filename)
+
+def _read_PNG(filename, target_size=None) :
+  """with target_size the image comes out resized to fit it (boxed pixels, ready for _convert_to_photoimage);
+  a straightlaced PNG is streamed, however large it is"""
+  return _run_steps(_read_PNG_steps(filename, target_size=target_size))
+      
+def _pack_pixels(pixels, out=None):
+  "packs rows of boxed pixels into RGB bytes, or row by row into the writable buffer out, when given"
+  rows = (bytes(v for pixel in row for v in pixel) for row in pixels)
+  if out is None :
+    return b''.join(rows)
+  offset = 0
+  for row in rows :
+    out[offset:offset+len(row)] = row
+    offset += len(row)
+  return out
+
+def _decode_banner(filename, format, target_size) :
+  "decodes one banner resized to target_size, for the pool tasks.  returns (width, height, rows), rows is None on failure"
+  if format == 'JPEG' :
+    img = _read_JPG(filename, target_size)
+  else :
+    img = _read_PNG(filename, target_size)
+  return img[:3]
+
+def _read_banner(filename, format, target_size) :
+  """the pool task: decodes, resizes and packs one banner in the worker, so only the small result comes
+  back.  returns (width, height, pixels, filename), pixels are packed RGB bytes or None"""
+  width, height, rows = _decode_banner(filename, format, target_size)
+  if rows is None :
+    return (0, 0, None, filename)
+  return (width, height, _pack_pixels(rows), filename)
+
+def _read_banner_shared(filename, format, target_size, name) :
+  """the pool task, when shared memory is available: like _read_banner, but the packed rows go into the
+  shared memory block name, which the parent sized for target_size.  returns only (name, width, height, stride),
+  or None if the banner failed to decode"""
+  width, height, rows = _decode_banner(filename, format, target_size)
+  if rows is None :
+    return None
+  stride = width * 3
+  shm = nanojpeg.njAttachShared(name) # the parent unlinks it
+  try :
+    if stride * height > shm.size :
+      return None
+    _pack_pixels(rows, shm.buf)
+  finally :
+    shm.close()
+  return (name, width, height, stride)
       
 def _convert_to_photoimage(img):
+  "img is (width, height, pixels), pixels being rows of boxed pixels or packed RGB bytes"
   width = img[0]
   height = img[1]
   pixels = img[2]
+  packed = not isinstance(pixels, list)
   
   Target = tkinter.PhotoImage(width=width, height=height)
   for y in range(height) :
-    pixelrow = ["#%02x%02x%02x" % x for x in pixels[y]]
+    if packed :
+      row = pixels[y*width*3:(y+1)*width*3]
+      pixelrow = ["#%02x%02x%02x" % x for x in zip(row[0::3], row[1::3], row[2::3])]
+    else :
+      pixelrow = ["#%02x%02x%02x" % x for x in pixels[y]]
     pixelrow = '{%s}' % ' '.join(pixelrow)
     Target.put(pixelrow, to=(0, y))
   return Target
 
+class BannerCache( object ) :
+  """resized banners kept on disk, so a warm start reads each one back with no decoding.  an entry is named
+  by the hash of the banner file, its mtime and the target size, and holds the raw RGB pixels after a
+  12 byte header (magic, width, height).  the least recently used entries go once they pass max_bytes"""
+  MAGIC = b'TCB1'
+  
+  def __init__(self, path, max_bytes):
+    self._path = path
+    self._max_bytes = max_bytes
+    self._hashes = {} # filename -> (mtime_ns, size, hash), so an unchanged banner is not read just to hash it
+    try :
+      os.makedirs(path, exist_ok=True)
+      with open(os.path.join(path, 'index'), 'r') as f :
+        for line in f :
+          mtime, size, digest, filename = line.rstrip('\n').split(' ', 3)
+          self._hashes[filename] = (int(mtime), int(size), digest)
+    except (OSError, ValueError) :
+      pass
+
+  def _entry(self, filename, size):
+    "the path of the entry for filename resized to size"
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    memo = self._hashes.get(filename)
+    if memo is None or memo[:2] != (st.st_mtime_ns, st.st_size) :
+      h = hashlib.sha1()
+      with open(filename, 'rb') as f :
+        for block in iter(lambda : f.read(1 << 20), b'') :
+          h.update(block)
+      memo = (st.st_mtime_ns, st.st_size, h.hexdigest())
+      self._hashes[filename] = memo
+    key = '%s %d %dx%d' % (memo[2], memo[0], size[0], size[1])
+    return os.path.join(self._path, hashlib.sha1(key.encode('ascii')).hexdigest() + '.rgb')
+
+  def get(self, filename, size):
+    "returns the cached (width, height, pixels) of filename resized to size, pixels packed, or None"
+    try :
+      entry = self._entry(filename, size)
+      with open(entry, 'rb') as f :
+        data = f.read()
+      os.utime(entry) # recently used
+    except OSError :
+      return None
+    if data[:4] != self.MAGIC :
+      return None
+    width, height = struct.unpack('>II', data[4:12])
+    if len(data) != 12 + width * height * 3 or not width :
+      return None
+    return (width, height, memoryview(data)[12:]) # packed, as it is
+
+  def put(self, filename, size, img):
+    "stores img (boxed or packed pixels), filename resized to size, then evicts down to max_bytes"
+    width, height, pixels = img[:3]
+    if isinstance(pixels, list) :
+      pixels = _pack_pixels(pixels)
+    data = self.MAGIC + struct.pack('>II', width, height) + pixels
+    try :
+      entry = self._entry(filename, size)
+      with open(entry + '.tmp', 'wb') as f : # renamed into place, a half written entry is never read
+        f.write(data)
+      os.replace(entry + '.tmp', entry)
+      self._save_index()
+      self._evict()
+    except OSError :
+      pass
+
+  def _save_index(self):
+    index = os.path.join(self._path, 'index')
+    with open(index + '.tmp', 'w') as f : # renamed into place like the entries, a crash never leaves half an index
+      for filename, (mtime, size, digest) in self._hashes.items() :
+        if os.path.exists(filename) :
+          f.write('%d %d %s %s\n' % (mtime, size, digest, filename))
+    os.replace(index + '.tmp', index)
+
+  def _evict(self):
+    entries = []
+    for name in os.listdir(self._path) :
+      if name.endswith('.tmp') : # left by a crash mid write, this process renames its own before evicting
+        os.remove(os.path.join(self._path, name))
+      elif name.endswith('.rgb') :
+        st = os.stat(os.path.join(self._path, name))
+        entries.append((st.st_mtime, st.st_size, name))
+    total = sum(x[1] for x in entries)
+    for mtime, size, name in sorted(entries) : # least recently used first
+      if total <= self._max_bytes :
+        break
+      os.remove(os.path.join(self._path, name))
+      total -= size
+
+  def clear(self):
+    "removes every entry"
+    self._hashes = {}
+    try :
+      for name in os.listdir(self._path) :
+        if name.endswith('.rgb') or name.endswith('.tmp') or name == 'index' :
+          os.remove(os.path.join(self._path, name))
+    except OSError :
+      pass
+
 class BannerController( object ) :
   def __init__(self, banner_seconds, banner_path, display_man):
     
     self._banner_duration = int(banner_seconds)
-    self._banner_list = []
-    if os.path.isdir( banner_path ):
-      messagebox.showinfo(TITLE, "Please wait while banners are processed.  It may take a few minutes.")
-      pool = multiprocessing.Pool()
-      for x in glob.glob( os.path.join( banner_path, "*.jpg" )) :
-        self._banner_list.append(pool.apply_async(_read_JPG, (x,)))
-      for x in glob.glob( os.path.join( banner_path, "*.png" )) :
-        self._banner_list.append(pool.apply_async(_read_PNG, (x,)))
-      pool.close()
-      pool.join()
-      self._banner_list = [x.get() for x in self._banner_list]
-        
-      for x in self._banner_list :
-        if x[2] is None :
-          messagebox.showerror(TITLE, "Banner %s failed to decode correctly." % x[3])
-          
-      self._banner_list = [(x[0], x[1], x[2]) for x in self._banner_list if x[2] is not None]
-    else:
-      messagebox.showerror(TITLE, "Missing banner directory %s" % banner_path)
-      
+    self._banners = [] # (filename, probe) pairs, in rotation order
+    self._images = {} # filename -> PhotoImage, only for the current banner and the next BANNER_LOOKAHEAD ones
     self.display_man = display_man
-    img_size = self.display_man.get_ideal_banner_size()
-    self.resize_banners( img_size[0], img_size[1] )
+    self._img_size = self.display_man.get_ideal_banner_size()
     
     self._run = True
+    self._waiting = False # the next banner is not ready yet, it is shown as soon as it is
     self._banner_cursor = -1
     self._update_time = datetime.datetime.now()  - datetime.timedelta(seconds=999)
     self._hold_time = 0
     
     self._timer = None
+    self._loaders = [] # (filename, generator) for the banners decoded in slices, taking turns
+    self._load_timer = None
+    self._loading = set() # filenames being decoded
+    self._pending = {} # filename -> (AsyncResult, the shared memory block it fills or None)
+    self._poll_timer = None
+    self._pool = None
+    self._cache = BannerCache(BANNER_CACHE_PATH, BANNER_CACHE_BYTES)
+    
+    if os.path.isdir( banner_path ):
+      self._banners = self._probe_banners(glob.glob( os.path.join( banner_path, "*.jpg" )) + glob.glob( os.path.join( banner_path, "*.png" )))
+      if multiprocessing.cpu_count() > 1 :
+        nanojpeg.njShareTracker() # so the shared memory blocks the workers attach to are not taken for leaks
+        self._pool = multiprocessing.Pool() # the one pool, kept for the night: each task decodes, resizes and packs a banner
+      # else a pool does not help on one core: decode in slices from the event loop instead, so the clock stays live
+      self._prepare()
+    else:
+      messagebox.showerror(TITLE, "Missing banner directory %s" % banner_path)
+      
     self.update_banner()
     
   def __del__(self):
@@ -1067,25 +1387,190 @@ class BannerController( object ) :
       self._display_man.cancel_timer( self._timer )
       self._timer = None
 
-  def resize_banners(self, width, height):
-    ret_list = []
-    pool = multiprocessing.Pool()
-    ret_list = [pool.apply_async(_img_resize, (x,width,height)) for x in self._banner_list]
-    pool.close()
-    pool.join()
-    ret_list = [x.get() for x in ret_list]
-    ret_list = [_convert_to_photoimage(x) for x in ret_list]
-      
-    self._banner_list = ret_list
-    
-    
+  def _report(self, text):
+    "a problem with one banner: logged and shown under the banner, the others carry on"
+    sys.stderr.write(text + '\n')
+    self.display_man.show_status(text)
+
+  def _probe_banners(self, filenames):
+    "reads only the file headers, rejects what cannot or should not be decoded, returns (filename, probe) pairs"
+    ret = []
+    for x in filenames :
+      info = probe(x)
+      if info is None :
+        self._report("Banner %s is not a JPEG or PNG file." % x)
+      elif info['format'] == 'JPEG' and info['progressive'] :
+        self._report("Banner %s is a progressive JPEG, which is not supported." % x)
+      elif info['width'] * info['height'] > BANNER_MAX_PIXELS and (info['format'] == 'JPEG' or info['progressive']) : # straightlaced PNGs are streamed
+        self._report("Banner %s is too large (%d x %d)." % (x, info['width'], info['height']))
+      else :
+        ret.append((x, info))
+    return ret
+
+  def _upcoming(self):
+    "the indices of the next BANNER_LOOKAHEAD banners in rotation"
+    n = len(self._banners)
+    return [(self._banner_cursor + i) % n for i in range(1, max(1, min(n - 1, BANNER_LOOKAHEAD)) + 1)] if n else []
+
+  def _prepare(self):
+    "materialises the current banner and the next BANNER_LOOKAHEAD ones, from the cache or in the background, drops the rest"
+    window = []
+    for i in ([self._banner_cursor] if self._banner_cursor >= 0 else []) + self._upcoming() :
+      if self._banners[i] not in window :
+        window.append(self._banners[i])
+    for x in list(self._images) :
+      if x not in [b[0] for b in window] :
+        del self._images[x]
+    for x, info in window :
+      if x in self._images or x in self._loading :
+        continue
+      img = self._cache.get(x, self._img_size)
+      if img is not None :
+        self._set_image(x, _convert_to_photoimage(img))
+      elif self._pool is not None :
+        self._loading.add(x)
+        if shared_memory is not None : # the parent owns the block, the worker only fills it
+          shm = shared_memory.SharedMemory(create=True, size=self._img_size[0] * self._img_size[1] * 3)
+          try :
+            result = self._pool.apply_async(_read_banner_shared, (x, info['format'], self._img_size, shm.name))
+          except Exception : # the pool is gone: the block would be left behind
+            shm.close()
+            shm.unlink()
+            raise
+          self._pending[x] = (result, shm)
+        else :
+          self._pending[x] = (self._pool.apply_async(_read_banner, (x, info['format'], self._img_size)), None)
+        self._show_thumbnail(x, info) # while the worker decodes
+      else :
+        self._loading.add(x)
+        self._loaders.append((x, self._load_banner(x, info)))
+        if not self._load_timer :
+          self._load_timer = self.display_man.start_timer(1, self._load_step)
+    if self._pending and not self._poll_timer :
+      self._poll_timer = self.display_man.start_timer(100, self._poll_step)
+
+  def _show_thumbnail(self, x, info):
+    "lets the EXIF thumbnail of x stand in until x is decoded, returns whether x has one"
+    if not info['thumbnail'] : # EXIF thumbnails decode in milliseconds
+      return False
+    try :
+      img = _run_steps(_decode_JPG_steps(info['thumbnail']))
+    except Exception :
+      return False
+    self._set_image(x, _convert_to_photoimage(_img_resize(img, self._img_size[0], self._img_size[1])))
+    return True
+
+  def _load_banner(self, x, info):
+    "generator decoding one banner a slice per step.  a thumbnail or an early pass stands in until it is done"
+    img_size = self._img_size
+    if self._show_thumbnail(x, info) :
+      yield
+    if info['format'] == 'PNG' :
+      steps = _read_PNG_steps(x, previews = True, target_size = img_size)
+    else :
+      steps = _read_JPG_steps(x, img_size)
+    while True : # like yield from, but an interlaced PNG hands over previews on the way, shown like thumbnails
+      try :
+        preview = next(steps)
+      except StopIteration as e :
+        img = e.value
+        break
+      if preview is not None :
+        preview = yield from _img_resize_steps(preview, img_size[0], img_size[1])
+        self._set_image(x, _convert_to_photoimage(preview))
+      yield
+    self._banner_done(x, img)
+
+  def _load_step(self):
+    "a step of the next loader in turn, so a slow banner does not hold up the ones after it"
+    self._load_timer = None
+    x, loader = self._loaders.pop(0)
+    try :
+      next(loader)
+      self._loaders.append((x, loader))
+    except StopIteration :
+      pass
+    if self._loaders and not self._load_timer :
+      self._load_timer = self.display_man.start_timer(1, self._load_step)
+
+  def _poll_step(self):
+    "collects what the pool has finished, in whatever order it finishes"
+    self._poll_timer = None
+    for x, (result, shm) in list(self._pending.items()) :
+      if result.ready() :
+        del self._pending[x]
+        try :
+          img = result.get()
+        except Exception :
+          img = None
+        if shm is None :
+          self._banner_done(x, img or (0, 0, None, x))
+          continue
+        pixels = None
+        if img is not None :
+          name, width, height, stride = img
+          pixels = shm.buf[:height*stride]
+          img = (width, height, pixels) # converted and cached straight from the block, not copied
+        try :
+          self._banner_done(x, img or (0, 0, None, x))
+        finally :
+          if pixels is not None :
+            pixels.release()
+          shm.close()
+          shm.unlink()
+    if self._pending and not self._poll_timer :
+      self._poll_timer = self.display_man.start_timer(100, self._poll_step)
+
+  def _banner_done(self, x, img):
+    self._loading.discard(x)
+    if img[2] is None :
+      self._report("Banner %s failed to decode correctly." % x)
+      self._drop_banner(x)
+    else :
+      self._cache.put(x, self._img_size, img)
+      self._set_image(x, _convert_to_photoimage(img)) # resized by the reader
+    self._prepare()
+
+  def _set_image(self, x, im):
+    "stores im for x, in place of its stand in, shows it at once if x is on display or the rotation is waiting"
+    self._images[x] = im
+    if self._banner_cursor >= 0 and self._banners[self._banner_cursor][0] == x :
+      self.display_man.apply_banner(im)
+    elif self._waiting and self._run :
+      self.update_banner()
+
+  def _drop_banner(self, x):
+    "takes x out of the rotation"
+    i = [b[0] for b in self._banners].index(x)
+    del self._banners[i]
+    self._images.pop(x, None)
+    if i <= self._banner_cursor :
+      self._banner_cursor -= 1
+    if self._waiting and self._run :
+      self.update_banner()
+
   def update_banner(self):
-    if self._banner_list :
+    if self._timer : # called early, by a banner the rotation was waiting for: one rotation timer at a time
+      self.display_man.cancel_timer(self._timer)
+    self._timer = None
+    self._waiting = False
+    if self._banners :
+      ready = [i for i in self._upcoming() if self._banners[i][0] in self._images]
+      if not ready :
+        self._waiting = True
+        return
+      if ready[0] != self._upcoming()[0] : # whatever finished first goes ahead of the banners still decoding
+        banner = self._banners.pop(ready[0])
+        if ready[0] < self._banner_cursor :
+          self._banner_cursor -= 1
+        self._banners.insert(self._banner_cursor + 1, banner)
       if self._run :
         self._timer = self.display_man.start_timer(self._banner_duration * 1000, self.update_banner)
-      self._banner_cursor = ( self._banner_cursor + 1 ) % len( self._banner_list )
-      self.display_man.apply_banner( self._banner_list[self._banner_cursor] )
+      self._banner_cursor = ( self._banner_cursor + 1 ) % len( self._banners )
+      x = self._banners[self._banner_cursor][0]
+      self.display_man.apply_banner( self._images[x] )
       self._update_time = datetime.datetime.now()
+      self._prepare()
     return
     
   def hold(self):
@@ -1107,6 +1592,21 @@ class BannerController( object ) :
     if self._timer :
       self.display_man.cancel_timer(self._timer)
     self._timer = None
+    if self._load_timer :
+      self.display_man.cancel_timer(self._load_timer)
+    self._load_timer = None
+    self._loaders = []
+    if self._poll_timer :
+      self.display_man.cancel_timer(self._poll_timer)
+    self._poll_timer = None
+    if self._pool is not None :
+      self._pool.terminate()
+    self._pool = None
+    for result, shm in self._pending.values() :
+      if shm is not None :
+        shm.close()
+        shm.unlink()
+    self._pending = {}
 
       
 #===============================================================================================
@@ -1198,6 +1698,9 @@ class TournamentClockApp( object ) :
   
 if __name__ == '__main__' :
 
+  if '--clear-banner-cache' in sys.argv[1:] :
+    BannerCache(BANNER_CACHE_PATH, BANNER_CACHE_BYTES).clear()
+    
   app = TournamentClockApp()
   app.run()
 